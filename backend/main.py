@@ -1,13 +1,25 @@
 import logging
+import socket
+import threading
 import time
-import boto3
+import uuid
 import datetime
-import json
+import gzip
 import os
-from typing import Optional, Tuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
 
+from botocore.exceptions import ClientError
+import numpy as np
 import pandas as pd
 
+from aws_clients import get_client
+from job_queue import JobQueue, get_job_queue
+from lambda_invoker import invoke_lambda
+from metrics import maybe_flush as maybe_flush_metrics, timer
+from s3_writer import S3MultipartWriter
+from sampler import ActivitySampler
+
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,37 +29,131 @@ REGION = 'us-east-1'
 TABLE_NAME = "AppJobs"
 INDEX_NAME = "jobToDo-requestedTs-index"
 NEW_JOB_STR = "Y"
+# jobToDo of a claimed job until it completes, so that a job whose worker
+# dies stays visible in the index and its chunks can be resumed
+RUNNING_JOB_STR = "R"
 
 LAMBDA_FUNCTION_NAME = os.getenv("LAMBDA_FUNCTION_NAME", "ml_app_lambda")
 LAMBDA_QUALIFIER = os.getenv("LAMBDA_QUALIFIER", '$LATEST')
 LAMBDA_REGION = os.getenv("LAMBDA_REGION", "us-east-1")
 
 S3_BUCKET = "ml-app-2020"
+# Results are streamed to S3 CSV_CHUNK_ROWS rows at a time in parts of
+# S3_PART_SIZE bytes, gzip-compressed on the fly if S3_GZIP is set
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "100000"))
+S3_PART_SIZE = int(os.getenv("S3_PART_SIZE", str(8 * 1024 * 1024)))
+S3_GZIP = os.getenv("S3_GZIP", "").lower() in ("1", "true", "yes")
+# Format of job results: "csv", "parquet" or "feather" (Arrow IPC)
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "csv").lower()
+OUTPUT_FORMATS = ("csv", "parquet", "feather")
+if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+    logger.warning(f"Unknown OUTPUT_FORMAT {OUTPUT_FORMAT}. Use csv instead")
+    OUTPUT_FORMAT = "csv"
 
+# Idle backoff: sleep IDLE_SLEEP_MIN_SEC after the first empty poll, double it
+# on every further empty poll up to SLEEP_SEC, and exit after MAX_IDLE_SEC
 SLEEP_SEC = 10
+IDLE_SLEEP_MIN_SEC = float(os.getenv("IDLE_SLEEP_MIN_SEC", "0.5"))
+MAX_IDLE_SEC = float(os.getenv("MAX_IDLE_SEC", "30"))
+
+# Job lease. The worker that assembles the result of a job and completes it
+# holds the job (workerId) until leaseExpiresTs, and extends the lease every
+# HEARTBEAT_SEC while it does. Once the lease expires, e.g. because the
+# worker died or the assembly failed, another worker takes over
+WORKER_ID = os.getenv(
+    "WORKER_ID", f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}")
+LEASE_SEC = int(os.getenv("LEASE_SEC", "300"))
+HEARTBEAT_SEC = int(os.getenv("HEARTBEAT_SEC", "60"))
+
+# A job is split into chunks of CHUNK_DAYS days. Every chunk is leased for
+# LEASE_SEC, written to S3 as its own part, and recorded in chunksDone, so a
+# job resumes from its missing chunks and its chunks run in parallel on any
+# free worker. A chunk has to finish well within LEASE_SEC
+CHUNK_DAYS = int(os.getenv("CHUNK_DAYS", "365"))
+
+# Progress (daysDone/daysTotal, daysPerSec, etaSec) is written with every
+# chunk checkpoint, together with pollAfterSec: how long the frontend may
+# cache the job status, ETA / POLL_ETA_FRACTION within
+# [POLL_MIN_SEC, POLL_MAX_SEC]
+POLL_MIN_SEC = float(os.getenv("POLL_MIN_SEC", "2"))
+POLL_MAX_SEC = float(os.getenv("POLL_MAX_SEC", "60"))
+POLL_ETA_FRACTION = float(os.getenv("POLL_ETA_FRACTION", "4"))
+
+# "poll": claim jobs from the jobToDo index. "queue": receive new-job events
+# from the JobQueue configured by JOB_QUEUE (see job_queue.py)
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "poll").lower()
+QUEUE_WAIT_SEC = float(os.getenv("QUEUE_WAIT_SEC", "20"))
+
+# Number of jobs processed concurrently
+NUM_WORKERS = int(os.getenv("NUM_WORKERS", str(os.cpu_count() or 1)))
+# Number of concurrent Lambda invocations shared by all jobs
+LAMBDA_CONCURRENCY = int(os.getenv("LAMBDA_CONCURRENCY", "8"))
+
+# Number of days requested from Lambda in one invocation, and how long to
+# wait for one batch before falling back to the local model
+LAMBDA_BATCH_SIZE = int(os.getenv("LAMBDA_BATCH_SIZE", "1000"))
+LAMBDA_BATCH_DEADLINE_SEC = float(os.getenv("LAMBDA_BATCH_DEADLINE_SEC", "30"))
+# A batch that has not answered after this long is sent again (see
+# lambda_invoker). Well above the latency of a batch, cold start included,
+# so that only a stuck invocation is duplicated
+LAMBDA_BATCH_HEDGE_SEC = float(os.getenv("LAMBDA_BATCH_HEDGE_SEC", "10"))
+
+# Local model used when Lambda is not available
+INIT_ACTIVITY_DB = {
+    "male": {
+        "basketball": 1,
+        "baseball": 1,
+        "swimming": 1,
+    },
+    "female": {
+        "shopping": 1,
+        "swimming": 1,
+    },
+}
 
 
 # Create DynamoDB client
-client = boto3.client('dynamodb', region_name=REGION)
-lambda_client = boto3.client('lambda', region_name=LAMBDA_REGION)
-s3_client = boto3.client('s3', region_name=REGION)
+client = get_client('dynamodb', REGION)
+lambda_client = get_client('lambda', LAMBDA_REGION)
+s3_client = get_client('s3', REGION)
+
+# Thread pool for the per-job Lambda invocations
+lambda_executor = ThreadPoolExecutor(max_workers=LAMBDA_CONCURRENCY)
+
+
+def is_conditional_check_failed(e: Exception) -> bool:
+    """Whether e is raised because a ConditionExpression is not met"""
+    return (
+        isinstance(e, ClientError)
+        and e.response.get("Error", {}).get("Code")
+        == "ConditionalCheckFailedException"
+    )
 
 
 def update_new_job(item: dict) -> Tuple[dict, bool]:
-    """Set the (jobId, requestedTs) to "working in progress"
+    """Claim (jobId, requestedTs) and set it to "working in progress"
+
+    The claim is a conditional update from jobToDo = NEW_JOB_STR to
+    RUNNING_JOB_STR, so only one worker can claim a job. The claiming worker
+    is recorded in workerId. The chunk size of the job is fixed to CHUNK_DAYS
+    of the first claim (chunkDays) and its chunk leases start empty. The job
+    lease is only taken to complete the job (see acquire_job_lease).
 
     Args:
-        item (dict):
+        item (dict): at least the key attributes (jobId, requestedTs). The
+            full item is returned on success
 
     Returns:
         dict: updated item (if update is successful)
-        bool: whether update is success or not
+        bool: whether update is success or not. False if another worker
+            has claimed the job first
 
     """
     jobId = item.get("jobId", {}).get('S', "")
     requestedTs = item.get("requestedTs").get('N', "")
+    now = time.time()
     try:
-        logger.info(f"Update jobId={jobId}, requestedTs={requestedTs}")
+        logger.info("Update jobId=%s, requestedTs=%s", jobId, requestedTs)
         response = client.update_item(
             TableName=TABLE_NAME,
             Key={
@@ -58,18 +164,47 @@ def update_new_job(item: dict) -> Tuple[dict, bool]:
                     "N": requestedTs,
                 },
             },
-            UpdateExpression="REMOVE jobToDo SET jobStatus = :val",
+            UpdateExpression=(
+                "SET jobToDo = :running, jobStatus = :val, workerId = :worker, "
+                "startedTs = if_not_exists(startedTs, :now), "
+                "chunkDays = if_not_exists(chunkDays, :days), "
+                "chunkLeases = if_not_exists(chunkLeases, :leases)"
+            ),
+            ConditionExpression="jobToDo = :new",
+            ReturnValues="ALL_NEW",
             ExpressionAttributeValues={
+                ':new': {
+                    'S': NEW_JOB_STR
+                },
+                ':running': {
+                    'S': RUNNING_JOB_STR
+                },
                 ':val': {
                     'S': "Working in progress"
-                }
+                },
+                ':days': {
+                    'N': str(CHUNK_DAYS)
+                },
+                ':leases': {
+                    'M': {}
+                },
+                ':worker': {
+                    'S': WORKER_ID
+                },
+                ':now': {
+                    'N': str(now)
+                },
             },
         )
     except Exception as e:
-        logger.error(
-            f"Fail to update {TABLE_NAME}. jobId = {jobId}, "
-            f"requestedTs={requestedTs}. Exception message: {e}"
-        )
+        if is_conditional_check_failed(e):
+            logger.info(
+                "jobId = %s has been claimed by another worker. Skip it", jobId)
+        else:
+            logger.error(
+                f"Fail to update {TABLE_NAME}. jobId = {jobId}, "
+                f"requestedTs={requestedTs}. Exception message: {e}"
+            )
         return item, False
 
     # Check response code
@@ -79,63 +214,592 @@ def update_new_job(item: dict) -> Tuple[dict, bool]:
         )
         return item, False
 
-    # Update item
-    item['jobStatus'] = {'S': "Working in progress"}
-    del item['jobToDo']
-    return item, True
+    # Claimed item as stored in DynamoDB
+    return response.get("Attributes", item), True
 
 
-def get_one_new_job() -> Optional[dict]:
-    """Get one new job from DynamoDB
+def acquire_job_lease(item: dict) -> Tuple[dict, bool]:
+    """Take the lease of a running job to this worker for LEASE_SEC
+
+    The lease can be taken if nobody holds it, its holder is gone (it has
+    expired) or this worker holds it already.
+
+    Args:
+        item (dict): job
 
     Returns:
-        Optional[dict]:
-            If there is new job, return a dict for the seleted new job
-            If there is no new job, return None. For example,
-                {'input': {'M': {'gender': {'S': 'Choose to not disclose'},
+        dict: job as stored in DynamoDB (if the lease is taken)
+        bool: whether the lease is taken. False if the job is complete or
+            another worker holds the lease
+    """
+    jobId = item.get("jobId", {}).get('S', "")
+    now = time.time()
+    try:
+        response = client.update_item(
+            TableName=TABLE_NAME,
+            Key={
+                "jobId": item["jobId"],
+                "requestedTs": item["requestedTs"],
+            },
+            UpdateExpression=(
+                "SET workerId = :worker, leaseExpiresTs = :lease, "
+                "heartbeatTs = :now"
+            ),
+            ConditionExpression=(
+                "jobToDo = :running AND (attribute_not_exists(leaseExpiresTs) "
+                "OR leaseExpiresTs < :now OR workerId = :worker)"
+            ),
+            ReturnValues="ALL_NEW",
+            ExpressionAttributeValues={
+                ':running': {
+                    'S': RUNNING_JOB_STR
+                },
+                ':worker': {
+                    'S': WORKER_ID
+                },
+                ':lease': {
+                    'N': str(now + LEASE_SEC)
+                },
+                ':now': {
+                    'N': str(now)
+                },
+            },
+        )
+    except Exception as e:
+        if is_conditional_check_failed(e):
+            logger.info(
+                "jobId = %s is complete or leased by another worker", jobId)
+        else:
+            logger.error(
+                f"Fail to lease jobId = {jobId}. Exception message: {e}")
+        return item, False
+    return response.get("Attributes", item), True
+
+
+def heartbeat_job(item: dict) -> bool:
+    """Extend the lease of a job owned by this worker
+
+    Args:
+        item (dict): claimed job
+
+    Returns:
+        bool: whether the lease is extended. False if the job is no longer
+            owned by this worker or the update fails
+    """
+    jobId = item.get("jobId", {}).get('S', "")
+    requestedTs = item.get("requestedTs").get('N', "")
+    now = time.time()
+    try:
+        _ = client.update_item(
+            TableName=TABLE_NAME,
+            Key={
+                "jobId": {
+                    "S": jobId,
+                },
+                "requestedTs": {
+                    "N": requestedTs,
+                },
+            },
+            UpdateExpression="SET leaseExpiresTs = :lease, heartbeatTs = :now",
+            ConditionExpression="workerId = :worker",
+            ExpressionAttributeValues={
+                ':worker': {
+                    'S': WORKER_ID
+                },
+                ':lease': {
+                    'N': str(now + LEASE_SEC)
+                },
+                ':now': {
+                    'N': str(now)
+                },
+            },
+        )
+    except Exception as e:
+        if is_conditional_check_failed(e):
+            logger.warning(
+                f"jobId = {jobId} is no longer owned by {WORKER_ID}")
+        else:
+            logger.error(
+                f"Fail to heartbeat {TABLE_NAME}. jobId = {jobId}, "
+                f"requestedTs={requestedTs}. Exception message: {e}"
+            )
+        return False
+    return True
+
+
+def start_heartbeat(item: dict) -> threading.Event:
+    """Call heartbeat_job(item) every HEARTBEAT_SEC in a daemon thread
+
+    Args:
+        item (dict): claimed job
+
+    Returns:
+        threading.Event: set it to stop the heartbeat
+    """
+    stop = threading.Event()
+
+    def _beat():
+        while not stop.wait(HEARTBEAT_SEC):
+            if not heartbeat_job(item):
+                break
+
+    threading.Thread(target=_beat, daemon=True).start()
+    return stop
+
+
+def claim_jobs(k: int) -> List[dict]:
+    """Claim up to k new jobs from DynamoDB
+
+    The jobToDo index is paged with Limit=k and every item of a page is
+    claimed with update_new_job, so a burst of k jobs costs one query
+    instead of k. Items claimed by another worker are skipped, and the next
+    page is read only when the current page did not yield k jobs.
+
+    Args:
+        k (int): maximum number of jobs to claim
+
+    Returns:
+        List[dict]: claimed jobs, oldest first. Empty list if there is no
+            new job or the query fails. For example,
+                [{'input': {'M': {'gender': {'S': 'Choose to not disclose'},
                 'tend': {'S': '2020-06-01'},
                 'tstart': {'S': '2020-02-01'}}},
-                'jobStatus': {'S': 'New'},
+                'jobStatus': {'S': 'Working in progress'},
+                'jobToDo': {'S': 'R'},
+                'chunkDays': {'N': '365'},
+                'chunkLeases': {'M': {}},
                 'jobId': {'S': '0e89023b-b2de-490d-8af2-e6b03acf516a'},
                 'requestedTs': {'N': '1608910278'},
-                'jobToDo': {'S': 'Y'}}
+                'workerId': {'S': 'ip-10-0-0-1-3f2a9c1d'},
+                'startedTs': {'N': '1608910278'}}]
     """
-    # No retry
+    claimed = []
+    kwargs = {}
+    while len(claimed) < k:
+        # No retry
+        try:
+            response = client.query(
+                TableName=TABLE_NAME,
+                IndexName=INDEX_NAME,
+                KeyConditionExpression='jobToDo = :x',
+                ExpressionAttributeValues={
+                    ':x': {
+                        'S': NEW_JOB_STR,
+                    }
+                },
+                Limit=k,
+                **kwargs,
+            )
+        except Exception as e:
+            logger.error(f"Cannot query {TABLE_NAME}. Exception message: {e}")
+            break
+
+        for item in response.get("Items", []):
+            item, ok = update_new_job(item)
+            if ok:
+                claimed.append(item)
+                if len(claimed) == k:
+                    break
+
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    if not claimed:
+        logger.info("There is no new jobs in %s", TABLE_NAME)
+    return claimed
+
+
+def get_one_new_job() -> Optional[dict]:
+    """Get one new job from DynamoDB
+
+    Returns:
+        Optional[dict]:
+            If there is new job, return a dict for the seleted new job
+            If there is no new job, return None. See claim_jobs for an
+            example
+    """
+    items = claim_jobs(1)
+    return items[0] if items else None
+
+
+def claim_job_event(event: dict) -> Tuple[Optional[dict], bool]:
+    """Claim the job referenced by a new-job event
+
+    Args:
+        event (dict): {"jobId": ..., "requestedTs": ...}
+
+    Returns:
+        Optional[dict]: claimed job. None if it cannot be claimed
+        bool: whether the event is handled and can be acked. False only if
+            the claim fails for a reason other than a lost race
+    """
+    jobId = event.get("jobId", "")
+    requestedTs = str(event.get("requestedTs", ""))
+    if not jobId or not requestedTs:
+        logger.error(f"Drop malformed job event: {event}")
+        return None, True
+
+    key = {"jobId": {"S": jobId}, "requestedTs": {"N": requestedTs}}
+    item, ok = update_new_job(key)
+    if ok:
+        return item, True
+
+    # Lost race and error look the same from update_new_job; look at the job
+    # to tell them apart
+    try:
+        response = client.get_item(
+            TableName=TABLE_NAME,
+            Key=key,
+            ProjectionExpression="jobToDo",
+        )
+    except Exception as e:
+        logger.error(
+            f"Cannot get {TABLE_NAME}. jobId = {jobId}. Exception message: {e}")
+        return None, False
+    jobToDo = response.get("Item", {}).get("jobToDo", {}).get("S")
+    return None, jobToDo != NEW_JOB_STR
+
+
+def get_job_chunks(item: dict) -> Optional[List[Tuple[datetime.date, datetime.date]]]:
+    """Split the [tstart, tend) of a job into chunks of chunkDays days
+
+    Args:
+        item (dict): job
+
+    Returns:
+        Optional[List[Tuple[datetime.date, datetime.date]]]: [tstart, tend) of
+            every chunk. None if the input of the job is invalid
+    """
+    try:
+        tstart = datetime.datetime.strptime(
+            item.get("input", {}).get('M', {}).get('tstart', {}).get('S', ""),
+            '%Y-%m-%d'
+        ).date()
+
+        tend = datetime.datetime.strptime(
+            item.get("input", {}).get('M', {}).get('tend', {}).get('S', ""),
+            '%Y-%m-%d'
+        ).date()
+    except Exception as e:
+        logger.error(
+            f"Failed to convert tstart and/or tend. item: {item}. "
+            f"Cannot process this task. Exception message: {e}"
+        )
+        return None
+
+    chunk_days = int(item.get("chunkDays", {}).get('N', CHUNK_DAYS))
+    chunks = []
+    while tstart < tend:
+        chunk_end = min(tstart + datetime.timedelta(days=chunk_days), tend)
+        chunks.append((tstart, chunk_end))
+        tstart = chunk_end
+    return chunks
+
+
+def get_claimable_chunks(item: dict, num_chunks: int) -> List[int]:
+    """Chunks of item that are neither done nor leased
+
+    Args:
+        item (dict): job
+        num_chunks (int): number of chunks of the job
+
+    Returns:
+        List[int]: chunk indexes, in order
+    """
+    now = time.time()
+    done = set(item.get("chunksDone", {}).get("NS", []))
+    leases = item.get("chunkLeases", {}).get("M", {})
+    chunks = []
+    for chunk in range(num_chunks):
+        if str(chunk) in done:
+            continue
+        lease = leases.get(str(chunk), {}).get("M", {})
+        if float(lease.get("leaseExpiresTs", {}).get("N", 0)) > now:
+            continue
+        chunks.append(chunk)
+    return chunks
+
+
+def is_waiting_for_completion(item: dict, num_chunks: int) -> bool:
+    """Whether all chunks of item are done but nobody is completing it
+
+    That is the case when the worker that was assembling its result died or
+    failed: its job lease (see acquire_job_lease) has expired.
+
+    Args:
+        item (dict): running job
+        num_chunks (int): number of chunks of the job
+
+    Returns:
+        bool: [description]
+    """
+    done = item.get("chunksDone", {}).get("NS", [])
+    lease_expires_ts = float(item.get("leaseExpiresTs", {}).get("N", 0))
+    return len(done) >= num_chunks and lease_expires_ts < time.time()
+
+
+def claim_chunk(item: dict, chunk: int, days_total: int) -> Tuple[dict, bool]:
+    """Lease one chunk of a running job to this worker for LEASE_SEC
+
+    A chunk can be claimed if it is not done and its lease (if any) has
+    expired, i.e. the worker that had it is gone.
+
+    Args:
+        item (dict): job
+        chunk (int): chunk index
+        days_total (int): number of days of the job, for progress reporting
+
+    Returns:
+        dict: job as stored in DynamoDB (if the claim is successful)
+        bool: whether the claim is successful. False if the chunk is done or
+            leased by another worker
+    """
+    jobId = item.get("jobId", {}).get('S', "")
+    now = time.time()
     try:
-        response = client.query(
+        response = client.update_item(
             TableName=TABLE_NAME,
-            IndexName=INDEX_NAME,
-            KeyConditionExpression='jobToDo = :x',
+            Key={
+                "jobId": item["jobId"],
+                "requestedTs": item["requestedTs"],
+            },
+            UpdateExpression=(
+                "SET chunkLeases.#c = :lease, daysTotal = :total, "
+                "daysDone = if_not_exists(daysDone, :zero)"
+            ),
+            ConditionExpression=(
+                "jobToDo = :running AND NOT contains(chunksDone, :chunk) AND "
+                "(attribute_not_exists(chunkLeases.#c) OR "
+                "chunkLeases.#c.leaseExpiresTs < :now)"
+            ),
+            ReturnValues="ALL_NEW",
+            ExpressionAttributeNames={'#c': str(chunk)},
             ExpressionAttributeValues={
-                ':x': {
-                    'S': NEW_JOB_STR,
-                }
+                ':running': {
+                    'S': RUNNING_JOB_STR
+                },
+                ':chunk': {
+                    'N': str(chunk)
+                },
+                ':now': {
+                    'N': str(now)
+                },
+                ':total': {
+                    'N': str(days_total)
+                },
+                ':zero': {
+                    'N': "0"
+                },
+                ':lease': {
+                    'M': {
+                        "workerId": {
+                            'S': WORKER_ID
+                        },
+                        "leaseExpiresTs": {
+                            'N': str(now + LEASE_SEC)
+                        },
+                    }
+                },
             },
         )
     except Exception as e:
-        logger.error(f"Cannot query {TABLE_NAME}. Exception messae: {e}")
-        return None
+        if not is_conditional_check_failed(e):
+            logger.error(
+                f"Fail to claim chunk {chunk} of jobId = {jobId}. "
+                f"Exception message: {e}"
+            )
+        return item, False
+    return response.get("Attributes", item), True
+
 
-    # Check if thre is any new jobs
-    if not response.get("Items"):
-        logger.info(f"There is no new jobs in {TABLE_NAME}")
-        item = None
+def get_progress(item: dict, days: int, days_total: int) -> dict:
+    """Progress of a job once `days` more days are done
+
+    Args:
+        item (dict): job before the update
+        days (int): days just completed
+        days_total (int): days of the job
+
+    Returns:
+        dict: daysPerSec, etaSec and pollAfterSec as DynamoDB numbers
+    """
+    now = time.time()
+    days_done = min(int(item.get("daysDone", {}).get('N', 0)) + days, days_total)
+    elapsed = now - float(item.get("startedTs", {}).get('N', now))
+    days_per_sec = days_done / elapsed if elapsed > 0 else 0.0
+    if days_per_sec > 0:
+        eta_sec = (days_total - days_done) / days_per_sec
     else:
-        # There is at least one new items
-        item = response.get("Items")[0]
-
-        # Update item from DynamoDB
-        jobId = item.get("jobId", {}).get('S', "")
-        requestedTs = item.get("requestedTs").get('N', "")
-        item, ok = update_new_job(item)
-        if not ok:
+        eta_sec = 0.0
+    poll_after_sec = min(max(eta_sec / POLL_ETA_FRACTION, POLL_MIN_SEC), POLL_MAX_SEC)
+    return {
+        "daysPerSec": {'N': f"{days_per_sec:.3f}"},
+        "etaSec": {'N': f"{eta_sec:.1f}"},
+        "pollAfterSec": {'N': f"{poll_after_sec:.1f}"},
+    }
+
+
+def complete_chunk(
+    item: dict, chunk: int, days: int, days_total: int,
+) -> Tuple[dict, bool]:
+    """Add chunk to chunksDone of the job, drop its lease and report progress
+
+    The progress is written by the checkpoint itself, so it costs no extra
+    request. A chunk that is done already (its lease expired while it was
+    running and another worker redid it) is not counted twice.
+
+    Args:
+        item (dict): job
+        chunk (int): chunk index
+        days (int): number of days of the chunk
+        days_total (int): number of days of the job
+
+    Returns:
+        dict: job as stored in DynamoDB (if the update is successful)
+        bool: whether the update is successful
+    """
+    jobId = item.get("jobId", {}).get('S', "")
+    progress = get_progress(item, days, days_total)
+    try:
+        response = client.update_item(
+            TableName=TABLE_NAME,
+            Key={
+                "jobId": item["jobId"],
+                "requestedTs": item["requestedTs"],
+            },
+            UpdateExpression=(
+                "ADD chunksDone :chunks, daysDone :days "
+                "SET daysPerSec = :rate, etaSec = :eta, pollAfterSec = :poll, "
+                "progressTs = :now "
+                "REMOVE chunkLeases.#c"
+            ),
+            ConditionExpression="NOT contains(chunksDone, :chunk)",
+            ReturnValues="ALL_NEW",
+            ExpressionAttributeNames={'#c': str(chunk)},
+            ExpressionAttributeValues={
+                ':chunk': {
+                    'N': str(chunk)
+                },
+                ':chunks': {
+                    'NS': [str(chunk)]
+                },
+                ':days': {
+                    'N': str(days)
+                },
+                ':rate': progress["daysPerSec"],
+                ':eta': progress["etaSec"],
+                ':poll': progress["pollAfterSec"],
+                ':now': {
+                    'N': str(time.time())
+                },
+            },
+        )
+    except Exception as e:
+        if is_conditional_check_failed(e):
+            logger.info("Chunk %d of jobId = %s is done already", chunk, jobId)
+        else:
             logger.error(
-                f"Failed to update DynamoDB. jobId={jobId}, "
-                f"requestedTs={requestedTs}"
+                f"Fail to checkpoint chunk {chunk} of jobId = {jobId}. "
+                f"Exception message: {e}"
             )
-            item = None
+        return item, False
+    return response.get("Attributes", item), True
 
-    return item
+
+def find_running_jobs(k: int) -> List[dict]:
+    """Find up to k running jobs that need a worker
+
+    These are jobs with chunks that no worker is working on: chunks not
+    started yet, which a free worker can run in parallel with the owner of
+    the job, and chunks whose worker is gone. And jobs whose chunks are all
+    done but that nobody is completing (see is_waiting_for_completion).
+
+    Args:
+        k (int): maximum number of jobs
+
+    Returns:
+        List[dict]: jobs, oldest first. The chunks are not claimed yet
+    """
+    jobs = []
+    kwargs = {}
+    while len(jobs) < k:
+        try:
+            response = client.query(
+                TableName=TABLE_NAME,
+                IndexName=INDEX_NAME,
+                KeyConditionExpression='jobToDo = :x',
+                ExpressionAttributeValues={
+                    ':x': {
+                        'S': RUNNING_JOB_STR,
+                    }
+                },
+                **kwargs,
+            )
+        except Exception as e:
+            logger.error(f"Cannot query {TABLE_NAME}. Exception message: {e}")
+            break
+
+        for item in response.get("Items", []):
+            chunks = get_job_chunks(item)
+            if chunks is None:
+                update_failed_job(item, "Invalid tstart and/or tend")
+                continue
+            if (
+                get_claimable_chunks(item, len(chunks))
+                or is_waiting_for_completion(item, len(chunks))
+            ):
+                jobs.append(item)
+                if len(jobs) == k:
+                    break
+
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return jobs
+
+
+def claim_work(k: int) -> List[dict]:
+    """Claim up to k new jobs, then fill up with running jobs to help
+
+    Args:
+        k (int): maximum number of jobs
+
+    Returns:
+        List[dict]: jobs to pass to process_job
+    """
+    items = claim_jobs(k)
+    if len(items) < k:
+        items += find_running_jobs(k - len(items))
+    return items
+
+
+def recommend_activities_local(
+    gender: str,
+    count: int,
+    activity_db: dict = INIT_ACTIVITY_DB,
+) -> Tuple[list, list]:
+    """Recommend `count` activities with the in-process model
+
+    It is the fallback when Lambda does not answer in time.
+
+    Args:
+        gender (str): [description]
+        count (int): number of activities to recommend
+        activity_db (dict): Activity DB
+
+    Returns:
+        list: all possible activities
+        list: recommended activities
+    """
+    gender = gender.lower()
+    act_cnt = dict()
+    for gender_tmp, act_cnt_map in activity_db.items():
+        if gender == gender_tmp or gender not in activity_db:
+            for act, cnt in act_cnt_map.items():
+                act_cnt[act] = act_cnt.get(act, 0) + cnt
+    sampler = ActivitySampler(act_cnt)
+    return sampler.activities, sampler.draw(count).tolist()
 
 
 def recommend_activity_lambda(
@@ -144,6 +808,9 @@ def recommend_activity_lambda(
 ) -> Tuple[list, str]:
     """Get activity recommendation by invoking Lambda function
 
+    Falls back to recommend_activities_local if Lambda does not answer
+    within LAMBDA_DEADLINE_SEC (see lambda_invoker).
+
     Args:
         gender (str): [description]
         past_act (str): [description]
@@ -151,74 +818,319 @@ def recommend_activity_lambda(
     Returns:
         Tuple[list, str]: [description]
     """
-    payload = json.dumps(
+    res = invoke_lambda(
+        lambda_client,
+        LAMBDA_FUNCTION_NAME,
+        LAMBDA_QUALIFIER,
         {
             "gender": gender,
             "past_act": past_act,
-        }
+        },
+        idempotent=not past_act,
     )
-    # Invoke Lambda fucntion (no re-try for now)
-    try:
-        response = lambda_client.invoke(
-            FunctionName=LAMBDA_FUNCTION_NAME,
-            Payload=payload,
-            Qualifier=LAMBDA_QUALIFIER
+    if not res or not res.get("recommended_activity"):
+        logger.warning(
+            f"No recommendation from Lambda function: {LAMBDA_FUNCTION_NAME}. "
+            "Use local model instead."
         )
+        act_list, acts = recommend_activities_local(gender, 1)
+        return act_list, acts[0]
 
-        res = json.loads(response['Payload'].read())
-    except Exception as e:
-        logger.error(
-            f"Cannot invoke Lambda function: {LAMBDA_FUNCTION_NAME}. Return no recommendation."
-            f"Error message: {e}"
+    return res.get("activity_list", []), res.get("recommended_activity", "")
+
+
+def recommend_activities_lambda(
+    gender: str,
+    count: int,
+    past_act: Optional[str] = "",
+) -> Tuple[list, list]:
+    """Get `count` activity recommendations with one Lambda invocation
+
+    Falls back to recommend_activities_local if Lambda does not answer
+    within LAMBDA_BATCH_DEADLINE_SEC.
+
+    Args:
+        gender (str): [description]
+        count (int): number of activities to recommend
+        past_act (str): [description]
+
+    Returns:
+        list: all possible activities
+        list: recommended activities
+    """
+    res = invoke_lambda(
+        lambda_client,
+        LAMBDA_FUNCTION_NAME,
+        LAMBDA_QUALIFIER,
+        {
+            "gender": gender,
+            "past_act": past_act,
+            "count": count,
+        },
+        idempotent=not past_act,
+        deadline_sec=LAMBDA_BATCH_DEADLINE_SEC,
+        hedge_sec=LAMBDA_BATCH_HEDGE_SEC,
+    )
+    if not res or len(res.get("recommended_activities", [])) != count:
+        logger.warning(
+            f"No recommendation from Lambda function: {LAMBDA_FUNCTION_NAME}. "
+            "Use local model instead."
         )
-        return [], ""
+        return recommend_activities_local(gender, count)
 
-    return res.get("activity_list", []), res.get("recommended_activity", "")
+    return res.get("activity_list", []), res.get("recommended_activities", [])
+
+
+def generate_plan(
+    gender: str,
+    tstart: datetime.date,
+    tend: datetime.date,
+) -> pd.DataFrame:
+    """Generate daily activity plan for [tstart, tend)
+
+    The date column is built with pd.date_range and the activities are
+    written into a preallocated array, LAMBDA_BATCH_SIZE days per Lambda
+    invocation, so no per-day Python loop is involved. The invocations run
+    concurrently on lambda_executor.
 
+    Args:
+        gender (str): [description]
+        tstart (datetime.date): first day of the plan
+        tend (datetime.date): day after the last day of the plan
 
-def write_df_to_s3_as_csv(df, key, bucket=S3_BUCKET) -> dict:
+    Returns:
+        pd.DataFrame: columns "date" and "activity". Days for which Lambda
+            fails to return recommendations have an empty activity
+    """
+    num_days = max((tend - tstart).days, 0)
+    activities = np.full(num_days, "", dtype=object)
+    futures = {}
+    for offset in range(0, num_days, LAMBDA_BATCH_SIZE):
+        count = min(LAMBDA_BATCH_SIZE, num_days - offset)
+        futures[offset] = lambda_executor.submit(
+            recommend_activities_lambda, gender, count)
+
+    for offset, future in futures.items():
+        count = min(LAMBDA_BATCH_SIZE, num_days - offset)
+        _, acts = future.result()
+        if len(acts) != count:
+            logger.error(
+                f"Expect {count} activities from Lambda but get {len(acts)}."
+                f" gender = {gender}, tstart = {tstart}, offset = {offset}"
+            )
+            continue
+        activities[offset:offset + count] = acts
+
+    with timer("dataframe_build_seconds", stage="plan"):
+        return pd.DataFrame({
+            "date": pd.date_range(tstart, periods=num_days, freq="D"),
+            "activity": activities,
+        })
+
+
+def write_df_to_s3_as_csv(
+    df, key, bucket=S3_BUCKET, compress=S3_GZIP, header=True,
+) -> dict:
     """Write df to s3
 
+    The CSV is produced CSV_CHUNK_ROWS rows at a time and streamed through a
+    multipart upload, so neither the full CSV string nor its encoded copy
+    is ever held in memory.
+
     Args:
         df ([type]): [description]
         bucket ([type]): [description]
         key ([type]): [description]
+        compress (bool): gzip the CSV on the fly
+        header (bool): write the header line
 
     Returns:
         dict: response
     """
     try:
-        response = s3_client.put_object(
-            Body=df.to_csv(index=False).encode(),
-            Bucket=bucket,
-            Key=key
-        )
+        with S3MultipartWriter(
+            s3_client, bucket, key, S3_PART_SIZE, content_type="text/csv"
+        ) as s3_file:
+            out = gzip.GzipFile(fileobj=s3_file, mode="wb") if compress else s3_file
+            for start in range(0, max(len(df), 1), CSV_CHUNK_ROWS):
+                chunk = df.iloc[start:start + CSV_CHUNK_ROWS]
+                out.write(chunk.to_csv(
+                    index=False, header=header and start == 0).encode())
+            if compress:
+                # Write the gzip trailer; s3_file stays open
+                out.close()
     except Exception as e:
         logger.error(
             f"Failed to write df to S3. Bucket = {bucket}. key = {key}"
             f"Exception message: {e}"
         )
         return {}
-    return response
+    return s3_file.response
+
+
+def write_df_to_s3_as_columnar(df, key, fmt, bucket=S3_BUCKET) -> dict:
+    """Write df to s3 as Parquet or Feather (Arrow IPC)
+
+    The activity column is written as a categorical, so it is stored
+    dictionary-encoded in both formats.
+
+    Args:
+        df ([type]): [description]
+        key ([type]): [description]
+        fmt (str): "parquet" or "feather"
+        bucket ([type]): [description]
+
+    Returns:
+        dict: response
+    """
+    df = df.assign(activity=df["activity"].astype("category"))
+    try:
+        with S3MultipartWriter(
+            s3_client, bucket, key, S3_PART_SIZE,
+            content_type="application/octet-stream",
+        ) as s3_file:
+            if fmt == "parquet":
+                df.to_parquet(s3_file, engine="pyarrow", index=False)
+            else:
+                df.reset_index(drop=True).to_feather(s3_file)
+    except Exception as e:
+        logger.error(
+            f"Failed to write df to S3 as {fmt}. Bucket = {bucket}. "
+            f"key = {key}. Exception message: {e}"
+        )
+        return {}
+    return s3_file.response
+
+
+def write_df_to_s3(df, jobId: str, fmt: str = OUTPUT_FORMAT) -> Tuple[str, dict]:
+    """Write the result of jobId to s3 in the given format
+
+    Args:
+        df ([type]): [description]
+        jobId (str): [description]
+        fmt (str): one of OUTPUT_FORMATS
+
+    Returns:
+        str: key
+        dict: response
+    """
+    if fmt == "csv":
+        key = f"daily_activity/{jobId}.csv" + (".gz" if S3_GZIP else "")
+        return key, write_df_to_s3_as_csv(df, key)
+
+    key = f"daily_activity/{jobId}.{fmt}"
+    return key, write_df_to_s3_as_columnar(df, key, fmt)
+
+
+def get_part_key(jobId: str, chunk: int) -> str:
+    """S3 key of the output of one chunk (header-less CSV)"""
+    return f"daily_activity/{jobId}/part-{chunk:05d}.csv"
+
+
+def assemble_parts_to_s3(
+    jobId: str, num_chunks: int, fmt: str = OUTPUT_FORMAT,
+) -> Tuple[str, dict]:
+    """Combine the chunk outputs of jobId into its result object
+
+    CSV parts are streamed one after the other into the result through a
+    multipart upload. Parquet and Feather are built from the parts in memory.
+
+    Args:
+        jobId (str): [description]
+        num_chunks (int): [description]
+        fmt (str): one of OUTPUT_FORMATS
+
+    Returns:
+        str: key
+        dict: response. Empty dict if it fails
+    """
+    if fmt != "csv":
+        try:
+            parts = [
+                pd.read_csv(
+                    s3_client.get_object(
+                        Bucket=S3_BUCKET, Key=get_part_key(jobId, chunk))["Body"],
+                    header=None,
+                    names=["date", "activity"],
+                    parse_dates=["date"],
+                    keep_default_na=False,
+                )
+                for chunk in range(num_chunks)
+            ]
+        except Exception as e:
+            logger.error(
+                f"Failed to read the parts of jobId = {jobId}. "
+                f"Exception message: {e}"
+            )
+            return "", {}
+        with timer("dataframe_build_seconds", stage="assemble"):
+            df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(
+                {"date": pd.to_datetime([]), "activity": []})
+        return write_df_to_s3(df, jobId, fmt)
+
+    key = f"daily_activity/{jobId}.csv" + (".gz" if S3_GZIP else "")
+    try:
+        with S3MultipartWriter(
+            s3_client, S3_BUCKET, key, S3_PART_SIZE, content_type="text/csv"
+        ) as s3_file:
+            out = gzip.GzipFile(fileobj=s3_file, mode="wb") if S3_GZIP else s3_file
+            out.write(b"date,activity\n")
+            for chunk in range(num_chunks):
+                body = s3_client.get_object(
+                    Bucket=S3_BUCKET, Key=get_part_key(jobId, chunk))["Body"]
+                for data in iter(lambda: body.read(S3_PART_SIZE), b""):
+                    out.write(data)
+            if S3_GZIP:
+                out.close()
+    except Exception as e:
+        logger.error(
+            f"Failed to assemble the parts of jobId = {jobId}. key = {key}. "
+            f"Exception message: {e}"
+        )
+        return key, {}
+    return key, s3_file.response
+
 
+def delete_parts_from_s3(jobId: str, num_chunks: int):
+    """Delete the chunk outputs of a completed job (best effort)"""
+    keys = [{"Key": get_part_key(jobId, chunk)} for chunk in range(num_chunks)]
+    # delete_objects takes at most 1000 keys
+    for start in range(0, len(keys), 1000):
+        try:
+            s3_client.delete_objects(
+                Bucket=S3_BUCKET,
+                Delete={"Objects": keys[start:start + 1000], "Quiet": True},
+            )
+        except Exception as e:
+            logger.error(
+                f"Failed to delete the parts of jobId = {jobId}. "
+                f"Exception message: {e}"
+            )
 
-def update_complete_job(item: dict, key: str) -> Tuple[dict, bool]:
+
+def update_complete_job(item: dict, key: str, fmt: str = "csv") -> Tuple[dict, bool]:
     """Update item with completed job information
 
+    The job leaves the jobToDo index. The update is conditional on the job
+    still running, so a job is completed once even if several workers
+    finish its last chunks at the same time.
+
     Args:
         item (dict): [description]
         key (str): [description]
+        fmt (str): format of the object at key
 
     Returns:
         dict: updated item
-        bool: whether the update is success or not
+        bool: whether the update is success or not. False if the job has
+            been completed already
 
     """
     jobId = item.get("jobId", {}).get('S', "")
     requestedTs = item.get("requestedTs").get('N', "")
     try:
         logger.info(
-            f"Job complete update: jobId={jobId}, requestedTs={requestedTs}")
+            "Job complete update: jobId=%s, requestedTs=%s", jobId, requestedTs)
         _ = client.update_item(
             TableName=TABLE_NAME,
             Key={
@@ -229,8 +1141,12 @@ def update_complete_job(item: dict, key: str) -> Tuple[dict, bool]:
                     "N": requestedTs,
                 },
             },
-            UpdateExpression="SET jobStatus = :val, outData = :out",
+            UpdateExpression="SET jobStatus = :val, outData = :out REMOVE jobToDo",
+            ConditionExpression="jobToDo = :running",
             ExpressionAttributeValues={
+                ':running': {
+                    'S': RUNNING_JOB_STR
+                },
                 ':val': {
                     'S': "Done"
                 },
@@ -241,20 +1157,27 @@ def update_complete_job(item: dict, key: str) -> Tuple[dict, bool]:
                         },
                         "Key": {
                             'S': key,
-                        }
+                        },
+                        "Format": {
+                            'S': fmt,
+                        },
                     }
                 }
             },
         )
     except Exception as e:
-        logger.error(
-            f"Job complete update fail: {TABLE_NAME}, jobId = {jobId}, "
-            f"requestedTs={requestedTs}. Exception message: {e}"
-        )
+        if is_conditional_check_failed(e):
+            logger.info("jobId = %s has been completed already", jobId)
+        else:
+            logger.error(
+                f"Job complete update fail: {TABLE_NAME}, jobId = {jobId}, "
+                f"requestedTs={requestedTs}. Exception message: {e}"
+            )
         return item, False
 
     # Update item
-    item["jobStatus"] = "Done"
+    item.pop("jobToDo", None)
+    item["jobStatus"] = {'S': "Done"}
     item["outData"] = {
         'M': {
             "Bucket": {
@@ -262,14 +1185,68 @@ def update_complete_job(item: dict, key: str) -> Tuple[dict, bool]:
             },
             "Key": {
                 'S': key,
-            }
+            },
+            "Format": {
+                'S': fmt,
+            },
         }
     }
     return item, True
 
 
+def update_failed_job(item: dict, reason: str) -> Tuple[dict, bool]:
+    """Set a job that cannot be run to "Failed" and take it off the jobToDo
+    index, so that no worker picks it up again
+
+    Args:
+        item (dict): new or running job
+        reason (str): why it failed, stored in jobError
+
+    Returns:
+        dict: updated item (if update is successful)
+        bool: whether the update is success or not
+    """
+    jobId = item.get("jobId", {}).get('S', "")
+    try:
+        _ = client.update_item(
+            TableName=TABLE_NAME,
+            Key={
+                "jobId": item["jobId"],
+                "requestedTs": item["requestedTs"],
+            },
+            UpdateExpression="SET jobStatus = :val, jobError = :err REMOVE jobToDo",
+            ConditionExpression="attribute_exists(jobToDo)",
+            ExpressionAttributeValues={
+                ':val': {
+                    'S': "Failed"
+                },
+                ':err': {
+                    'S': reason
+                },
+            },
+        )
+    except Exception as e:
+        if not is_conditional_check_failed(e):
+            logger.error(
+                f"Job failed update fail: {TABLE_NAME}, jobId = {jobId}. "
+                f"Exception message: {e}"
+            )
+        return item, False
+
+    item.pop("jobToDo", None)
+    item["jobStatus"] = {'S': "Failed"}
+    item["jobError"] = {'S': reason}
+    return item, True
+
+
 def run_task(item: dict) -> dict:
-    """Run task defined by item
+    """Run the chunks of the job defined by item
+
+    Chunks are claimed one at a time until none is left, so several workers
+    can run the same job. Every chunk is written to S3 as its own part and
+    checkpointed in chunksDone together with the progress of the job.
+    Whoever sees all chunks done takes the job lease, assembles the parts
+    into the result and completes the job.
 
     Args:
         item (dict): [description]
@@ -282,56 +1259,195 @@ def run_task(item: dict) -> dict:
 
     # Get gender
     gender = item.get("input", {}).get('M', {}).get('gender', {}).get('S')
-    try:
-        tstart = datetime.datetime.strptime(
-            item.get("input", {}).get('M', {}).get('tstart', {}).get('S', ""),
-            '%Y-%m-%d'
-        ).date()
+    chunks = get_job_chunks(item)
+    if chunks is None:
+        item, _ = update_failed_job(item, "Invalid tstart and/or tend")
+        return item
+    days_total = sum((tend - tstart).days for tstart, tend in chunks)
 
-        tend = datetime.datetime.strptime(
-            item.get("input", {}).get('M', {}).get('tend', {}).get('S', ""),
-            '%Y-%m-%d'
-        ).date()
-    except Exception as e:
-        logger.error(
-            f"Failed to convert tstart and/or tend. item: {item}. "
-            f"Cannot process this task. Exception message: {e}"
-        )
+    while True:
+        claimed = False
+        for chunk in get_claimable_chunks(item, len(chunks)):
+            item, claimed = claim_chunk(item, chunk, days_total)
+            if claimed:
+                break
+        if not claimed:
+            break
+
+        # Create output df of the chunk
+        tstart, tend = chunks[chunk]
+        logger.info("Run chunk %d/%d of jobId = %s", chunk + 1, len(chunks), jobId)
+        with timer("chunk_seconds"):
+            with timer("generate_plan_seconds"):
+                df = generate_plan(gender, tstart, tend)
+
+            # Write df to S3. A failed chunk is retried once its lease expires
+            if not write_df_to_s3_as_csv(
+                    df, get_part_key(jobId, chunk), compress=False, header=False):
+                return item
+        item, _ = complete_chunk(item, chunk, (tend - tstart).days, days_total)
+
+    done = item.get("chunksDone", {}).get("NS", [])
+    if len(done) < len(chunks) or item.get("jobToDo", {}).get("S") != RUNNING_JOB_STR:
+        # Chunks left to other workers, or the job is complete
         return item
 
-    # Create output df
-    data = {
-        "date": [],
-        "activity": [],
-    }
-    day = tstart
-    while day < tend:
-        _, rec_act = recommend_activity_lambda(gender)
-        data['date'].append(day)
-        data["activity"].append(rec_act)
-        day += datetime.timedelta(days=1)
-    df = pd.DataFrame(data)
-
-    # Write df to S3
-    key = f"daily_activity/{jobId}.csv"
-    _ = write_df_to_s3_as_csv(df, key)
+    item, ok = acquire_job_lease(item)
+    if not ok:
+        return item
+    # A failed assembly or completion is retried once the lease expires
+    stop_heartbeat = start_heartbeat(item)
+    try:
+        key, response = assemble_parts_to_s3(jobId, len(chunks), OUTPUT_FORMAT)
+        if not response:
+            return item
 
-    # Update item
-    item, ok = update_complete_job(item, key)
+        # Update item
+        item, ok = update_complete_job(item, key, OUTPUT_FORMAT)
+    finally:
+        stop_heartbeat.set()
+    if ok:
+        delete_parts_from_s3(jobId, len(chunks))
+    return item
+
+
+def process_job(item: dict) -> dict:
+    """Run one claimed or running job in a worker thread
+
+    Args:
+        item (dict): job
+
+    Returns:
+        dict: updated item
+    """
+    jobId = item.get("jobId", {}).get('S', "")
+    logger.info("Processing job: %s", jobId)
+    try:
+        with timer("job_seconds"):
+            item = run_task(item)
+    except Exception as e:
+        logger.error(f"Failed to process job: {jobId}. Exception message: {e}")
+    else:
+        logger.info("Complete job: %s", jobId)
     return item
 
 
+def run_poll_loop():
+    """Process jobs with NUM_WORKERS worker threads until the queue is idle
+
+    New jobs are claimed whenever a worker is free. When the queue is empty,
+    the poll interval backs off from IDLE_SLEEP_MIN_SEC to SLEEP_SEC, and the
+    backend exits once it has been idle for MAX_IDLE_SEC.
+    """
+    running = set()
+    backoff = IDLE_SLEEP_MIN_SEC
+    idle_sec = 0.0
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        while True:
+            maybe_flush_metrics()
+            # Fill all free workers
+            free = NUM_WORKERS - len(running)
+            items = claim_work(free) if free else []
+            for item in items:
+                running.add(executor.submit(process_job, item))
+            if items:
+                backoff = IDLE_SLEEP_MIN_SEC
+                idle_sec = 0.0
+            queue_empty = len(items) < free
+
+            if not queue_empty:
+                # All workers are busy; wait for a free one
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+                continue
+
+            if not running and idle_sec >= MAX_IDLE_SEC:
+                logger.info("No new job for %.1f seconds", idle_sec)
+                break
+
+            # Queue is empty; back off before polling again
+            logger.info("No new job. Poll again in %.1f seconds", backoff)
+            if running:
+                _, running = wait(
+                    running, timeout=backoff, return_when=FIRST_COMPLETED)
+            else:
+                sleep_sec = max(min(backoff, MAX_IDLE_SEC - idle_sec), 0)
+                time.sleep(sleep_sec)
+                idle_sec += sleep_sec
+            backoff = min(backoff * 2, SLEEP_SEC)
+
+
+def run_queue_loop(job_queue: JobQueue):
+    """Process jobs announced on job_queue until it has been idle for MAX_IDLE_SEC
+
+    Jobs already waiting in the jobToDo index are claimed first; after that
+    the backend long-polls job_queue for as many events as it has free
+    workers, so a new job starts as soon as its event is received. Running
+    jobs with chunks left (see find_running_jobs) are looked up at most every
+    SLEEP_SEC while no event arrives.
+
+    Args:
+        job_queue (JobQueue): [description]
+    """
+    running = set()
+    idle_sec = 0.0
+    last_scan = time.monotonic()
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        for item in claim_work(NUM_WORKERS):
+            running.add(executor.submit(process_job, item))
+
+        while True:
+            maybe_flush_metrics()
+            if running:
+                _, running = wait(running, timeout=0)
+            free = NUM_WORKERS - len(running)
+            if not free:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+                continue
+
+            # Long poll even while jobs run: a job that finishes meanwhile only
+            # frees a worker, which the next receive asks for
+            wait_sec = min(QUEUE_WAIT_SEC, max(MAX_IDLE_SEC - idle_sec, 0))
+            start = time.monotonic()
+            try:
+                events = job_queue.receive(free, wait_sec)
+            except Exception as e:
+                logger.error(f"Cannot receive job events. Exception message: {e}")
+                events = []
+                time.sleep(wait_sec)
+
+            if not events and time.monotonic() - last_scan >= SLEEP_SEC:
+                last_scan = time.monotonic()
+                for item in find_running_jobs(free):
+                    running.add(executor.submit(process_job, item))
+
+            for event, receipt in events:
+                item, handled = claim_job_event(event)
+                if item:
+                    running.add(executor.submit(process_job, item))
+                if handled:
+                    try:
+                        job_queue.ack(receipt)
+                    except Exception as e:
+                        logger.error(
+                            f"Cannot ack job event {event}. Exception message: {e}")
+
+            if events or running:
+                idle_sec = 0.0
+            else:
+                idle_sec += time.monotonic() - start
+                if idle_sec >= MAX_IDLE_SEC:
+                    logger.info("No new job for %.1f seconds", idle_sec)
+                    break
+
+
 def main():
-    item = get_one_new_job()
-    while item:
-        jobId = item.get("jobId", {}).get('S', "")
-        logger.info(f"Processing new job: {jobId}")
-        _ = run_task(item)
-        logger.info(f"Complete job: {jobId}")
-        if SLEEP_SEC:
-            logger.info(f"Sleep for {SLEEP_SEC} seconds")
-            time.sleep(SLEEP_SEC)
-        item = get_one_new_job()
+    job_queue = get_job_queue() if DISPATCH_MODE == "queue" else None
+    if DISPATCH_MODE == "queue" and job_queue is None:
+        logger.error("DISPATCH_MODE=queue but no JOB_QUEUE. Poll instead")
+    if job_queue is not None:
+        run_queue_loop(job_queue)
+    else:
+        run_poll_loop()
 
 
 if __name__ == "__main__":
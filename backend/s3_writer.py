@@ -0,0 +1,144 @@
+import logging
+from typing import Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class S3MultipartWriter(object):
+    """Write-only file-like object that streams bytes to an S3 object
+
+    Bytes are buffered until part_size is reached and then sent with
+    upload_part, so at most one part is held in memory. An object smaller
+    than one part is sent with a single put_object instead.
+
+    Usage:
+        with S3MultipartWriter(s3_client, bucket, key) as f:
+            f.write(b"...")
+        response = f.response
+
+    If the with-block raises, the multipart upload is aborted and nothing is
+    written to S3.
+    """
+
+    def __init__(
+        self,
+        s3_client: Any,
+        bucket: str,
+        key: str,
+        part_size: int = MIN_PART_SIZE,
+        content_type: Optional[str] = None,
+    ):
+        """A new S3MultipartWriter
+
+        Args:
+            s3_client (Any): S3 client
+            bucket (str): [description]
+            key (str): [description]
+            part_size (int): size of each uploaded part, at least 5 MiB
+            content_type (Optional[str]): ContentType of the object
+        """
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.extra_args = {"ContentType": content_type} if content_type else {}
+        self.response = {}
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._position = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        """Number of bytes written so far"""
+        return self._position
+
+    def write(self, data: bytes) -> int:
+        """Buffer data and upload every full part"""
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[:self.part_size]))
+            del self._buffer[:self.part_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, body: bytes):
+        if self._upload_id is None:
+            response = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                **self.extra_args,
+            )
+            self._upload_id = response["UploadId"]
+        part_number = len(self._parts) + 1
+        response = self.s3_client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self._parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        """Upload what is left and complete the object"""
+        if self.closed:
+            return
+        if self._upload_id is None:
+            # Small object: one request
+            self.response = self.s3_client.put_object(
+                Body=bytes(self._buffer),
+                Bucket=self.bucket,
+                Key=self.key,
+                **self.extra_args,
+            )
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self.response = self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                MultipartUpload={"Parts": self._parts},
+            )
+        self._buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """Abort the multipart upload (if any)"""
+        self.closed = True
+        self._buffer = bytearray()
+        if self._upload_id is None:
+            return
+        try:
+            self.s3_client.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+            )
+        except Exception as e:
+            logger.error(
+                f"Failed to abort multipart upload. Bucket = {self.bucket}. "
+                f"key = {self.key}. Exception message: {e}"
+            )
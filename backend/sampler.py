@@ -0,0 +1,166 @@
+"""Fenwick-tree sampler for activity recommendation
+
+The same module is shipped in frontend/, backend/ and lambda/ (each
+directory is built as its own Docker image). Keep the copies identical
+(checked by make check_shared).
+"""
+import os
+import threading
+from typing import Dict, Optional, Union
+
+import numpy as np
+
+# Seed of the process-wide Generator. Unset means seeded from OS entropy
+SAMPLER_SEED = os.getenv("SAMPLER_SEED")
+
+# Long-lived Generator shared by all samplers. Generator is not thread safe
+_rng = np.random.default_rng(
+    None if SAMPLER_SEED is None else int(SAMPLER_SEED))
+_rng_lock = threading.Lock()
+
+
+def get_rng() -> np.random.Generator:
+    """Get the process-wide Generator"""
+    return _rng
+
+
+class ActivitySampler(object):
+    """Draw activities with probability proportional to their count
+
+    Counts are kept in a Fenwick (binary indexed) tree, so update() costs
+    O(log n) and drawing N activities costs O(N log n), with the tree
+    descent vectorized over the N draws. Nothing is rebuilt between an
+    update and the next draw.
+
+    Example:
+        sampler = ActivitySampler({"basketball": 3, "swimming": 1})
+        act = sampler.draw()        # e.g. 'basketball'
+        sampler.update("swimming", 2)
+        acts = sampler.draw(365)    # np.ndarray of 365 activities
+    """
+
+    def __init__(
+        self,
+        act_cnt: Dict[str, int],
+        rng: Optional[np.random.Generator] = None,
+    ):
+        """A new ActivitySampler
+
+        Args:
+            act_cnt (Dict[str, int]): activity -> count
+            rng (Optional[np.random.Generator]): Generator to draw from.
+                Default to the process-wide Generator
+        """
+        self._rng = rng if rng is not None else _rng
+        self._rng_lock = _rng_lock if rng is None else threading.Lock()
+        self._lock = threading.Lock()
+        self._activities = list(act_cnt)
+        self._index = {act: i for i, act in enumerate(self._activities)}
+        counts = np.fromiter(act_cnt.values(), dtype=np.int64, count=len(act_cnt))
+        self._total = int(counts.sum())
+        self._build(counts, max(len(counts), 1))
+
+    @property
+    def activities(self) -> list:
+        """All activities, in insertion order"""
+        return list(self._activities)
+
+    @property
+    def total(self) -> int:
+        """Sum of all counts"""
+        return self._total
+
+    def counts(self) -> Dict[str, int]:
+        """Current activity -> count"""
+        with self._lock:
+            n = len(self._activities)
+            return dict(zip(self._activities, self._counts[:n].tolist()))
+
+    def _build(self, counts: np.ndarray, size: int):
+        """Build the tree over counts, with room for size activities
+
+        Args:
+            counts (np.ndarray): count of every activity
+            size (int): number of activities the tree can hold, at least
+                len(counts)
+        """
+        # A power of two, so the descent in _search never leaves the tree
+        capacity = 1 << (size - 1).bit_length()
+        self._counts = np.zeros(capacity, dtype=np.int64)
+        self._counts[:len(counts)] = counts
+        # 1-based: node i holds the sum of counts (i - lowbit(i), i]
+        cumsum = np.concatenate(([0], np.cumsum(self._counts)))
+        nodes = np.arange(1, capacity + 1)
+        self._tree = np.zeros(capacity + 1, dtype=np.int64)
+        self._tree[1:] = cumsum[nodes] - cumsum[nodes - (nodes & -nodes)]
+        self._acts = np.empty(capacity, dtype=object)
+        self._acts[:len(self._activities)] = self._activities
+
+    def update(self, activity: str, cnt: int = 1):
+        """Add cnt to the count of activity
+
+        Args:
+            activity (str): [description]
+            cnt (int): increment
+        """
+        with self._lock:
+            idx = self._index.get(activity)
+            if idx is None:
+                idx = len(self._activities)
+                self._index[activity] = idx
+                self._activities.append(activity)
+                if idx == len(self._counts):
+                    # Full: double the capacity
+                    self._build(self._counts, 2 * idx)
+                else:
+                    self._acts[idx] = activity
+            self._counts[idx] += cnt
+            self._total += cnt
+            node = idx + 1
+            while node < len(self._tree):
+                self._tree[node] += cnt
+                node += node & -node
+
+    def _search(self, targets: np.ndarray) -> np.ndarray:
+        """Index of the activity of every target count
+
+        Args:
+            targets (np.ndarray): counts in [0, total)
+
+        Returns:
+            np.ndarray: smallest index i with targets < sum(counts[:i + 1])
+        """
+        tree = self._tree
+        pos = np.zeros(len(targets), dtype=np.int64)
+        rem = targets.astype(np.int64)
+        step = (len(tree) - 1) >> 1
+        while step:
+            nxt = pos + step
+            node = tree[nxt]
+            take = node <= rem
+            pos = np.where(take, nxt, pos)
+            rem = np.where(take, rem - node, rem)
+            step >>= 1
+        return pos
+
+    def draw(self, size: Optional[int] = None) -> Union[str, np.ndarray]:
+        """Draw activities
+
+        Args:
+            size (Optional[int]): number of activities. None draws one
+
+        Returns:
+            Union[str, np.ndarray]: one activity if size is None, otherwise
+                an array of size activities
+
+        Raises:
+            ValueError: if all counts are zero
+        """
+        num = 1 if size is None else size
+        with self._lock:
+            if self._total <= 0:
+                raise ValueError("Cannot draw from zero total count")
+            with self._rng_lock:
+                targets = self._rng.integers(self._total, size=num)
+            res = self._acts[self._search(targets)]
+        return res[0] if size is None else res
@@ -0,0 +1,314 @@
+"""Benchmarks of the hot paths of the three services against local fakes
+
+Every target runs in its own subprocess, because frontend/, backend/ and
+lambda/ each have modules with the same names (main, aws_clients, ...). A
+target registers the fakes of benchmarks/fakes.py with aws_clients before
+it imports the service, then times each case and reports p50/p95/p99
+latency, throughput and the peak memory allocated per call.
+
+Usage:
+    python benchmarks/bench.py
+    python benchmarks/bench.py --target backend --requests 50 --latency-ms 20
+    python benchmarks/bench.py --json > bench.json
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+TARGETS = ("lambda", "backend", "frontend")
+
+ACTIVITIES = ["basketball", "baseball", "swimming", "shopping", "hiking",
+              "running", "cycling", "reading", "cooking", "tennis"]
+
+
+def percentile(values: List[float], q: float) -> float:
+    """q-th percentile of values (nearest rank)"""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    rank = min(max(int(round(q / 100 * len(values) + 0.5)) - 1, 0), len(values) - 1)
+    return values[rank]
+
+
+def measure(
+    name: str,
+    fn: Callable[[], object],
+    requests: int,
+    concurrency: int,
+    memory_samples: int,
+) -> Dict[str, float]:
+    """Time requests calls of fn on concurrency threads
+
+    Args:
+        name (str): case name
+        fn (Callable[[], object]): one request
+        requests (int): number of timed calls
+        concurrency (int): number of calls in flight
+        memory_samples (int): number of extra calls traced with tracemalloc
+
+    Returns:
+        Dict[str, float]: case result
+    """
+    fn()  # warm up
+
+    def timed(_):
+        start = time.perf_counter()
+        fn()
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    # Peak allocation of one call. tracemalloc is restarted for every call,
+    # so the peak is not carried over from the previous one
+    peaks = []
+    for _ in range(memory_samples):
+        tracemalloc.start()
+        fn()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "case": name,
+        "requests": requests,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "per_sec": requests / elapsed if elapsed > 0 else 0.0,
+        "mem_kib": sum(peaks) / len(peaks) / 1024 if peaks else 0.0,
+    }
+
+
+def use_service(service: str):
+    """Put the service directory first on sys.path"""
+    sys.path.insert(0, os.path.join(ROOT_DIR, service))
+
+
+def bench_lambda(args) -> List[dict]:
+    use_service("lambda")
+    from fakes import FakeDynamoDB, Latency
+    from aws_clients import set_client
+
+    ddb = FakeDynamoDB(
+        {"male": {a: i + 1 for i, a in enumerate(ACTIVITIES)},
+         "female": {a: len(ACTIVITIES) - i for i, a in enumerate(ACTIVITIES)}},
+        latency=Latency(args.latency_ms / 1000, args.jitter_ms / 1000),
+    )
+    set_client("dynamodb", ddb, "us-east-1")
+    import prediction
+
+    run = lambda name, fn: measure(
+        name, fn, args.requests, args.concurrency, args.memory_samples)
+    results = [
+        run("handler", lambda: prediction.handler({"gender": "male"}, None)),
+        run("handler unknown gender",
+            lambda: prediction.handler({"gender": "n/a"}, None)),
+        run("handler past_act",
+            lambda: prediction.handler({"gender": "male", "past_act": "hiking"}, None)),
+        run(f"handler batch {args.days}",
+            lambda: prediction.handler({"gender": "male", "count": args.days}, None)),
+    ]
+
+    # Every request refreshes the count from DynamoDB
+    cache_ttl_sec = prediction.CACHE_TTL_SEC
+    prediction.CACHE_TTL_SEC = 0
+    results.append(run("handler cache miss",
+                       lambda: prediction.handler({"gender": "male"}, None)))
+    prediction.CACHE_TTL_SEC = cache_ttl_sec
+    return results
+
+
+def bench_backend(args) -> List[dict]:
+    use_service("backend")
+    from fakes import FakeDynamoDB, FakeLambda, FakeS3, Latency, recommend_uniformly
+    from aws_clients import set_client
+
+    latency = Latency(args.latency_ms / 1000, args.jitter_ms / 1000)
+    ddb = FakeDynamoDB(latency=latency)
+    s3 = FakeS3(latency=latency)
+    set_client("dynamodb", ddb, "us-east-1")
+    set_client("s3", s3, "us-east-1")
+    set_client("lambda", FakeLambda(recommend_uniformly(ACTIVITIES), latency),
+               os.getenv("LAMBDA_REGION", "us-east-1"))
+    import datetime
+    import main
+
+    tstart = datetime.date(2020, 1, 1)
+    tend = tstart + datetime.timedelta(days=args.days)
+
+    def run_job():
+        # Submit, claim and run one job end to end
+        key = {"jobId": {"S": str(uuid.uuid4())}, "requestedTs": {"N": str(time.time())}}
+        ddb.put_item(TableName=main.TABLE_NAME, Item=dict(key, **{
+            "jobToDo": {"S": main.NEW_JOB_STR},
+            "jobStatus": {"S": "New"},
+            "input": {"M": {
+                "gender": {"S": "male"},
+                "tstart": {"S": tstart.strftime("%Y-%m-%d")},
+                "tend": {"S": tend.strftime("%Y-%m-%d")},
+            }},
+        }))
+        item, ok = main.update_new_job(key)
+        item = main.run_task(item)
+        if item.get("jobStatus", {}).get("S") != "Done":
+            raise RuntimeError(f"Job is not done: {item}")
+
+    df = main.generate_plan("male", tstart, tend)
+    run = lambda name, fn: measure(
+        name, fn, args.requests, args.concurrency, args.memory_samples)
+    return [
+        run(f"run_task {args.days} days", run_job),
+        run(f"generate_plan {args.days} days",
+            lambda: main.generate_plan("male", tstart, tend)),
+        run(f"write_df_to_s3 {args.days} rows",
+            lambda: main.write_df_to_s3(df, str(uuid.uuid4()), "csv")),
+    ]
+
+
+def bench_frontend(args) -> List[dict]:
+    use_service("frontend")
+    from fakes import FakeDynamoDB, FakeLambda, FakeS3, Latency, recommend_uniformly
+    from aws_clients import set_client
+
+    latency = Latency(args.latency_ms / 1000, args.jitter_ms / 1000)
+    ddb = FakeDynamoDB(latency=latency)
+    s3 = FakeS3(latency=latency)
+    lambda_client = FakeLambda(recommend_uniformly(ACTIVITIES), latency)
+    set_client("dynamodb", ddb, "us-east-1")
+    set_client("s3", s3, "us-east-1")
+    set_client("lambda", lambda_client, os.getenv("LAMBDA_REGION", "us-east-1"))
+    from cache import TTLCache
+    from lambda_invoker import invoke_lambda
+    from sampler import ActivitySampler
+
+    sampler = ActivitySampler({a: i + 1 for i, a in enumerate(ACTIVITIES)})
+    cache = TTLCache(1024)
+    run = lambda name, fn: measure(
+        name, fn, args.requests, args.concurrency, args.memory_samples)
+    results = [
+        run(f"ActivitySampler.draw {args.days}", lambda: sampler.draw(args.days)),
+        run("TTLCache set+get",
+            lambda: cache.set(uuid.uuid4().hex, 1, ttl=5) or cache.get("missing")),
+        run("invoke_lambda",
+            lambda: invoke_lambda(lambda_client, "ml_app_lambda", "$LATEST",
+                                  {"gender": "male"})),
+    ]
+
+    # main.py needs streamlit; it runs in bare mode outside `streamlit run`
+    try:
+        import main
+    except ImportError as e:
+        print(f"Skip frontend main.py cases: {e}", file=sys.stderr)
+        return results
+
+    import datetime
+    tstart = datetime.date(2020, 1, 1)
+    tend = tstart + datetime.timedelta(days=args.days)
+    job_id = str(uuid.uuid4())
+    ddb.put_item(TableName=main.TABLE_NAME, Item={
+        "jobId": {"S": job_id},
+        "requestedTs": {"N": str(time.time())},
+        "jobStatus": {"S": "Working in progress"},
+    })
+    results += [
+        run(f"generate_plan {args.days} days",
+            lambda: main.generate_plan("male", tstart, tend, main.INIT_ACTIVITY_DB)),
+        run("recommend_activity_lambda",
+            lambda: main.recommend_activity_lambda("male", "", lambda_client)),
+        run("download_job (no cache)", lambda: main.download_job(job_id, ddb)),
+        run("download_job_cached", lambda: main.download_job_cached(job_id, ddb)),
+    ]
+    return results
+
+
+def run_target(target: str, args) -> List[dict]:
+    """Run one target in this process"""
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, BENCH_DIR)
+    return {
+        "lambda": bench_lambda,
+        "backend": bench_backend,
+        "frontend": bench_frontend,
+    }[target](args)
+
+
+def print_table(results: List[dict]):
+    header = (f"{'target':<9} {'case':<32} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} "
+              f"{'p99 ms':>9} {'ops/s':>10} {'KiB/op':>9}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['target']:<9} {r['case']:<32} {r['requests']:>6} "
+              f"{r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} "
+              f"{r['per_sec']:>10.1f} {r['mem_kib']:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--target", choices=TARGETS + ("all",), default="all")
+    parser.add_argument("--requests", type=int, default=200,
+                        help="timed calls per case")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="calls in flight per case")
+    parser.add_argument("--memory-samples", type=int, default=5,
+                        help="extra calls per case traced for memory")
+    parser.add_argument("--days", type=int, default=365,
+                        help="days per plan / batch")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="latency injected in every fake AWS call")
+    parser.add_argument("--jitter-ms", type=float, default=0.0,
+                        help="+/- jitter of the injected latency")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON lines")
+    parser.add_argument("--in-process", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.in_process:
+        for result in run_target(args.target, args):
+            print(json.dumps(dict(result, target=args.target)))
+        return
+
+    targets = TARGETS if args.target == "all" else (args.target,)
+    results = []
+    failed = False
+    for target in targets:
+        cmd = [
+            sys.executable, os.path.abspath(__file__), "--in-process",
+            "--target", target,
+            "--requests", str(args.requests),
+            "--concurrency", str(args.concurrency),
+            "--memory-samples", str(args.memory_samples),
+            "--days", str(args.days),
+            "--latency-ms", str(args.latency_ms),
+            "--jitter-ms", str(args.jitter_ms),
+        ]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        if proc.returncode:
+            print(f"Benchmark of {target} failed", file=sys.stderr)
+            failed = True
+            continue
+        results += [json.loads(line) for line in proc.stdout.splitlines() if line]
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_table(results)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
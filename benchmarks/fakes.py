@@ -0,0 +1,412 @@
+"""In-process stand-ins of the DynamoDB, S3 and Lambda clients
+
+The fakes implement the subset of the boto3 API the services call, with the
+same request/response shapes, and sleep for an injected latency on every
+call so network-bound paths can be measured without AWS. They are
+registered with aws_clients.set_client before a service module is
+imported, so the module picks them up instead of boto3 clients.
+"""
+import copy
+import io
+import json
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+
+class Latency(object):
+    """Injected latency: latency_sec +/- jitter_sec per call"""
+
+    def __init__(self, latency_sec: float = 0.0, jitter_sec: float = 0.0):
+        self.latency_sec = latency_sec
+        self.jitter_sec = jitter_sec
+
+    def wait(self):
+        delay = self.latency_sec + random.uniform(-self.jitter_sec, self.jitter_sec)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FakeClient(object):
+    """Base of the fakes: latency injection and a call counter per operation"""
+
+    def __init__(self, latency: Optional[Latency] = None):
+        self.latency = latency or Latency()
+        self.calls: Dict[str, int] = dict()
+        self._lock = threading.RLock()
+
+    def _call(self, operation: str):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+        self.latency.wait()
+
+
+def _conditional_check_failed(operation: str) -> ClientError:
+    return ClientError(
+        {"Error": {
+            "Code": "ConditionalCheckFailedException",
+            "Message": "The conditional request failed",
+        }},
+        operation,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Expressions (the subset used by the services)
+# ---------------------------------------------------------------------------
+
+_TOKEN = re.compile(r"\s*(\(|\)|,|<>|<=|>=|=|<|>|[#:\w][\w#:.\-]*)")
+
+
+def _tokenize(expression: str) -> List[str]:
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKEN.match(expression, pos)
+        if not match:
+            raise ValueError(f"Cannot parse expression: {expression[pos:]}")
+        tokens.append(match.group(1))
+        pos = match.end()
+    return tokens
+
+
+def _path(path: str, names: dict) -> List[str]:
+    return [names.get(p, p) for p in path.split(".")]
+
+
+def _get(item: dict, path: str, names: dict) -> Optional[dict]:
+    value = {"M": item}
+    for p in _path(path, names):
+        if p not in value.get("M", {}):
+            return None
+        value = value["M"][p]
+    return value
+
+
+def _set(item: dict, path: str, value: dict, names: dict):
+    parts = _path(path, names)
+    for p in parts[:-1]:
+        item = item[p]["M"]
+    item[parts[-1]] = copy.deepcopy(value)
+
+
+def _remove(item: dict, path: str, names: dict):
+    parts = _path(path, names)
+    for p in parts[:-1]:
+        if p not in item:
+            return
+        item = item[p]["M"]
+    item.pop(parts[-1], None)
+
+
+def _number(value: float) -> dict:
+    return {"N": str(int(value)) if float(value).is_integer() else str(value)}
+
+
+def evaluate_condition(expression: str, item: dict, values: dict, names: dict) -> bool:
+    """Evaluate a ConditionExpression (AND/OR/NOT, comparisons, functions)"""
+    tokens = _tokenize(expression)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take():
+        pos[0] += 1
+        return tokens[pos[0] - 1]
+
+    def operand():
+        token = take()
+        return values[token] if token.startswith(":") else _get(item, token, names)
+
+    def primary():
+        token = peek()
+        if token == "(":
+            take()
+            result = disjunction()
+            take()
+            return result
+        if token == "NOT":
+            take()
+            return not primary()
+        if token in ("attribute_exists", "attribute_not_exists", "contains"):
+            take()
+            take()
+            value = _get(item, take(), names)
+            arg = None
+            if peek() == ",":
+                take()
+                arg = values[take()]
+            take()
+            if token == "attribute_exists":
+                return value is not None
+            if token == "attribute_not_exists":
+                return value is None
+            if value is None:
+                return False
+            return list(arg.values())[0] in list(value.values())[0]
+        left = operand()
+        op = take()
+        right = operand()
+        if left is None or right is None:
+            return False
+        if op == "=":
+            return left == right
+        if op == "<>":
+            return left != right
+        a, b = float(left["N"]), float(right["N"])
+        return {"<": a < b, "<=": a <= b, ">": a > b, ">=": a >= b}[op]
+
+    def conjunction():
+        result = primary()
+        while peek() == "AND":
+            take()
+            result = primary() and result
+        return result
+
+    def disjunction():
+        result = conjunction()
+        while peek() == "OR":
+            take()
+            result = conjunction() or result
+        return result
+
+    return disjunction()
+
+
+def _split_actions(actions: str) -> List[str]:
+    parts, depth, current = [], 0, ""
+    for c in actions:
+        depth += {"(": 1, ")": -1}.get(c, 0)
+        if c == "," and depth == 0:
+            parts.append(current.strip())
+            current = ""
+        else:
+            current += c
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def apply_update(expression: str, item: dict, values: dict, names: dict):
+    """Apply an UpdateExpression (SET, REMOVE and ADD clauses)"""
+    for clause in re.split(r"\s(?=(?:SET|REMOVE|ADD)\s)", " " + expression):
+        clause = clause.strip()
+        if not clause:
+            continue
+        action, rest = clause.split(" ", 1)
+        for part in _split_actions(rest):
+            if action == "REMOVE":
+                _remove(item, part, names)
+            elif action == "SET":
+                path, value = [x.strip() for x in part.split("=", 1)]
+                match = re.match(r"if_not_exists\((.+),\s*(:\w+)\)", value)
+                if match:
+                    current = _get(item, match.group(1), names)
+                    value = current if current is not None else values[match.group(2)]
+                else:
+                    value = values[value]
+                _set(item, path, value, names)
+            else:
+                path, value = part.split()
+                current = _get(item, path, names)
+                value = values[value]
+                if "N" in value:
+                    total = float(value["N"]) + float((current or {"N": 0})["N"])
+                    _set(item, path, _number(total), names)
+                else:
+                    kind = list(value)[0]
+                    members = set((current or {kind: []})[kind]) | set(value[kind])
+                    _set(item, path, {kind: sorted(members)}, names)
+
+
+# ---------------------------------------------------------------------------
+# DynamoDB
+# ---------------------------------------------------------------------------
+
+class FakeDynamoDB(FakeClient):
+    """DynamoDB with the ActivityCnt and AppJobs tables
+
+    ActivityCnt is keyed by (gender, activity). AppJobs is keyed by jobId
+    and queried through the jobToDo-requestedTs-index.
+    """
+
+    def __init__(
+        self,
+        act_cnt: Optional[Dict[str, Dict[str, int]]] = None,
+        page_size: int = 1000,
+        latency: Optional[Latency] = None,
+    ):
+        super().__init__(latency)
+        self.page_size = page_size
+        self.act_cnt = {
+            g: dict(cnt) for g, cnt in (act_cnt or {}).items()}
+        self.jobs: Dict[str, dict] = dict()
+
+    def put_item(self, TableName: str, Item: dict, **kwargs) -> dict:
+        self._call("put_item")
+        with self._lock:
+            self.jobs[Item["jobId"]["S"]] = copy.deepcopy(Item)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def get_item(self, TableName: str, Key: dict, **kwargs) -> dict:
+        self._call("get_item")
+        with self._lock:
+            item = self.jobs.get(Key["jobId"]["S"])
+            return {"Item": copy.deepcopy(item)} if item else {}
+
+    def query(self, TableName: str, **kwargs) -> dict:
+        self._call("query")
+        values = kwargs.get("ExpressionAttributeValues", {})
+        with self._lock:
+            if TableName == "ActivityCnt":
+                gender = values[":genderVal"]["S"]
+                items = [
+                    {"gender": {"S": gender}, "activity": {"S": a}, "cnt": {"N": str(c)}}
+                    for a, c in sorted(self.act_cnt.get(gender, {}).items())
+                ]
+                key_of = lambda i: i["activity"]["S"]
+            else:
+                job_to_do = values[":x"]["S"]
+                items = sorted(
+                    (copy.deepcopy(i) for i in self.jobs.values()
+                     if i.get("jobToDo", {}).get("S") == job_to_do),
+                    key=lambda i: float(i["requestedTs"]["N"]),
+                )
+                if not kwargs.get("ScanIndexForward", True):
+                    items.reverse()
+                key_of = lambda i: i["jobId"]["S"]
+
+        start = 0
+        if "ExclusiveStartKey" in kwargs:
+            last = key_of(kwargs["ExclusiveStartKey"])
+            keys = [key_of(i) for i in items]
+            start = keys.index(last) + 1 if last in keys else len(items)
+        limit = min(kwargs.get("Limit", self.page_size), self.page_size)
+        page = items[start:start + limit]
+        response = {"Count": len(page), "ResponseMetadata": {"HTTPStatusCode": 200}}
+        if kwargs.get("Select") != "COUNT":
+            response["Items"] = page
+        if start + limit < len(items):
+            response["LastEvaluatedKey"] = dict(page[-1])
+        return response
+
+    def update_item(self, TableName: str, Key: dict, **kwargs) -> dict:
+        self._call("update_item")
+        values = kwargs.get("ExpressionAttributeValues", {})
+        names = kwargs.get("ExpressionAttributeNames", {})
+        with self._lock:
+            if TableName == "ActivityCnt":
+                gender, activity = Key["gender"]["S"], Key["activity"]["S"]
+                cnt = self.act_cnt.setdefault(gender, {})
+                cnt[activity] = cnt.get(activity, 0) + int(values[":x"]["N"])
+                return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+            item = self.jobs.setdefault(Key["jobId"]["S"], copy.deepcopy(Key))
+            condition = kwargs.get("ConditionExpression")
+            if condition and not evaluate_condition(condition, item, values, names):
+                raise _conditional_check_failed("UpdateItem")
+            apply_update(kwargs["UpdateExpression"], item, values, names)
+            response = {"ResponseMetadata": {"HTTPStatusCode": 200}}
+            if kwargs.get("ReturnValues") == "ALL_NEW":
+                response["Attributes"] = copy.deepcopy(item)
+            return response
+
+
+# ---------------------------------------------------------------------------
+# S3
+# ---------------------------------------------------------------------------
+
+class FakeS3(FakeClient):
+    """S3 kept in a dict, with multipart uploads and presigned URLs"""
+
+    def __init__(self, latency: Optional[Latency] = None):
+        super().__init__(latency)
+        self.objects: Dict[tuple, bytes] = dict()
+        self._uploads: Dict[str, Dict[int, bytes]] = dict()
+
+    def put_object(self, Bucket: str, Key: str, Body: Any, **kwargs) -> dict:
+        self._call("put_object")
+        self.objects[(Bucket, Key)] = Body if isinstance(Body, bytes) else Body.read()
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._call("get_object")
+        if (Bucket, Key) not in self.objects:
+            raise ClientError(
+                {"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs) -> dict:
+        self._call("delete_objects")
+        for obj in Delete["Objects"]:
+            self.objects.pop((Bucket, obj["Key"]), None)
+        return {}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._call("create_multipart_upload")
+        with self._lock:
+            upload_id = str(len(self._uploads) + 1)
+            self._uploads[upload_id] = dict()
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs) -> dict:
+        self._call("upload_part")
+        self._uploads[UploadId][PartNumber] = bytes(Body)
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs) -> dict:
+        self._call("complete_multipart_upload")
+        parts = self._uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(
+            parts[p["PartNumber"]] for p in MultipartUpload["Parts"])
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs) -> dict:
+        self._call("abort_multipart_upload")
+        self._uploads.pop(UploadId, None)
+        return {}
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs) -> str:
+        self._call("generate_presigned_url")
+        return f"https://{Params['Bucket']}.s3.local/{Params['Key']}?expires={ExpiresIn}"
+
+
+# ---------------------------------------------------------------------------
+# Lambda
+# ---------------------------------------------------------------------------
+
+def recommend_uniformly(activity_list: List[str]) -> Callable[[dict], dict]:
+    """A Lambda handler that draws activities uniformly from activity_list"""
+
+    def handler(event: dict) -> dict:
+        count = event.get("count")
+        if count is None:
+            return {
+                "activity_list": activity_list,
+                "recommended_activity": random.choice(activity_list),
+            }
+        return {
+            "activity_list": activity_list,
+            "recommended_activities": random.choices(activity_list, k=int(count)),
+        }
+
+    return handler
+
+
+class FakeLambda(FakeClient):
+    """Lambda whose function is a Python callable of the event"""
+
+    def __init__(self, handler: Callable[[dict], dict], latency: Optional[Latency] = None):
+        super().__init__(latency)
+        self.handler = handler
+
+    def invoke(self, FunctionName: str, Payload: str, Qualifier: str = "$LATEST", **kwargs) -> dict:
+        self._call("invoke")
+        payload = json.dumps(self.handler(json.loads(Payload))).encode()
+        return {"StatusCode": 200, "Payload": io.BytesIO(payload)}
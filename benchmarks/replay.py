@@ -0,0 +1,226 @@
+"""Replay a request log (REQUEST_LOG_PATH, see request_log.py)
+
+Records are streamed from the log through a bounded asyncio pipeline: a
+reader schedules every record at its original offset divided by --speed
+and puts it on a queue of --queue-size records, and --concurrency workers
+serve them on a thread pool. When the workers fall behind, the queue fills
+up and the reader waits, so memory stays bounded and the lag shows up in
+the report instead of in an ever-growing backlog.
+
+"recommend" records are sent to lambda/prediction.handler and "job"
+records are submitted, claimed and run with backend/main.run_task. Both
+use the fakes of benchmarks/fakes.py unless --aws is given.
+
+The recorded past_act is dropped unless --keep-past-act is given, so a
+replay does not add the recorded activities to ActivityCnt a second time.
+Against real AWS, anything that writes (job records, or past_act with
+--keep-past-act) also needs --allow-aws-writes.
+
+Usage:
+    python benchmarks/replay.py requests.log --target lambda --speed 10
+    python benchmarks/replay.py requests.log --target backend --speed 0 --json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List
+
+from bench import ACTIVITIES, BENCH_DIR, percentile, use_service
+
+KINDS = {"lambda": "recommend", "backend": "job"}
+
+
+def read_records(path: str, kind: str) -> Iterator[dict]:
+    """Records of kind from the log at path, in file order"""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("kind") == kind:
+                yield record
+
+
+def lambda_server(args) -> Callable[[dict], None]:
+    use_service("lambda")
+    if not args.aws:
+        from fakes import FakeDynamoDB, Latency
+        from aws_clients import set_client
+        set_client("dynamodb", FakeDynamoDB(
+            {"male": {a: i + 1 for i, a in enumerate(ACTIVITIES)},
+             "female": {a: len(ACTIVITIES) - i for i, a in enumerate(ACTIVITIES)}},
+            latency=Latency(args.latency_ms / 1000),
+        ), "us-east-1")
+    import prediction
+
+    def serve(record: dict):
+        event = {
+            "gender": record.get("gender", "n/a"),
+            "past_act": record.get("past_act", "") if args.keep_past_act else "",
+        }
+        if record.get("count") is not None:
+            event["count"] = record["count"]
+        prediction.handler(event, None)
+
+    return serve
+
+
+def backend_server(args) -> Callable[[dict], None]:
+    use_service("backend")
+    if not args.aws:
+        from fakes import FakeDynamoDB, FakeLambda, FakeS3, Latency, recommend_uniformly
+        from aws_clients import set_client
+        latency = Latency(args.latency_ms / 1000)
+        set_client("dynamodb", FakeDynamoDB(latency=latency), "us-east-1")
+        set_client("s3", FakeS3(latency=latency), "us-east-1")
+        set_client("lambda", FakeLambda(recommend_uniformly(ACTIVITIES), latency),
+                   os.getenv("LAMBDA_REGION", "us-east-1"))
+    import main
+
+    def serve(record: dict):
+        key = {"jobId": {"S": str(uuid.uuid4())}, "requestedTs": {"N": str(time.time())}}
+        main.client.put_item(TableName=main.TABLE_NAME, Item=dict(key, **{
+            "jobToDo": {"S": main.NEW_JOB_STR},
+            "jobStatus": {"S": "New"},
+            "input": {"M": {
+                "gender": {"S": record.get("gender", "n/a")},
+                "tstart": {"S": record["tstart"]},
+                "tend": {"S": record["tend"]},
+            }},
+        }))
+        item, ok = main.update_new_job(key)
+        if ok:
+            main.run_task(item)
+
+    return serve
+
+
+async def replay(
+    records: Iterator[dict],
+    serve: Callable[[dict], None],
+    speed: float,
+    concurrency: int,
+    queue_size: int,
+) -> Dict[str, List[float]]:
+    """Serve records at speed x their original pace
+
+    Args:
+        records (Iterator[dict]): request records, oldest first
+        serve (Callable[[dict], None]): serves one record (blocking)
+        speed (float): 1 replays at the original pace, 10 ten times faster
+            and 0 as fast as possible
+        concurrency (int): number of records served at the same time
+        queue_size (int): max number of records read ahead
+
+    Returns:
+        Dict[str, List[float]]: per-record latency_sec and lag_sec (start
+            of serving minus scheduled start), and the errors raised
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    stats = {"latency_sec": [], "lag_sec": [], "errors": []}
+
+    async def reader():
+        first_ts = None
+        start = time.monotonic()
+        for record in records:
+            ts = float(record.get("ts", 0))
+            if first_ts is None:
+                first_ts = ts
+            scheduled = start + ((ts - first_ts) / speed if speed > 0 else 0)
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await queue.put((scheduled, record))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def worker():
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            scheduled, record = entry
+            begin = time.monotonic()
+            try:
+                await loop.run_in_executor(executor, serve, record)
+            except Exception as e:
+                stats["errors"].append(str(e))
+            stats["latency_sec"].append(time.monotonic() - begin)
+            stats["lag_sec"].append(max(begin - scheduled, 0.0))
+
+    await asyncio.gather(reader(), *[worker() for _ in range(concurrency)])
+    executor.shutdown()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("path", help="request log (JSON lines)")
+    parser.add_argument("--target", choices=tuple(KINDS), default="lambda")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed factor; 0 replays as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, default=100)
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="latency injected in every fake AWS call")
+    parser.add_argument("--aws", action="store_true",
+                        help="use real AWS clients instead of the fakes")
+    parser.add_argument("--keep-past-act", action="store_true",
+                        help="send the recorded past_act, which increments "
+                        "ActivityCnt")
+    parser.add_argument("--allow-aws-writes", action="store_true",
+                        help="allow --aws to write job records or past_act "
+                        "to the real tables")
+    parser.add_argument("--json", action="store_true",
+                        help="print the summary as JSON")
+    args = parser.parse_args()
+    writes = args.target == "backend" or args.keep_past_act
+    if args.aws and writes and not args.allow_aws_writes:
+        parser.error(
+            "this replay writes to the real AWS tables; "
+            "add --allow-aws-writes if that is intended")
+
+    logging.disable(logging.WARNING)
+    sys.path.insert(0, BENCH_DIR)
+    serve = {"lambda": lambda_server, "backend": backend_server}[args.target](args)
+    records = read_records(args.path, KINDS[args.target])
+
+    start = time.perf_counter()
+    stats = asyncio.run(replay(
+        records, serve, args.speed, args.concurrency, args.queue_size))
+    elapsed = time.perf_counter() - start
+
+    latencies = stats["latency_sec"]
+    summary = {
+        "target": args.target,
+        "requests": len(latencies),
+        "errors": len(stats["errors"]),
+        "elapsed_sec": round(elapsed, 3),
+        "per_sec": round(len(latencies) / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "lag_p99_ms": round(percentile(stats["lag_sec"], 99) * 1000, 3),
+    }
+    if args.json:
+        print(json.dumps(summary))
+    else:
+        for key, value in summary.items():
+            print(f"{key:<12} {value}")
+    sys.exit(1 if stats["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
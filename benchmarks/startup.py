@@ -0,0 +1,197 @@
+"""Cold start benchmark of the Lambda function (lambda/prediction.py)
+
+Every run starts a fresh Python process, like a new Lambda container, which
+imports prediction.py (the init) and serves two requests. The DynamoDB
+client is a real boto3 client pointed at a local endpoint
+(AWS_ENDPOINT_URL_DYNAMODB) served by this script, so the import and
+client costs are measured as they are on Lambda, without AWS access.
+
+Scenarios:
+    eager         INIT_MODE=eager
+    lazy          INIT_MODE=lazy
+    warm          INIT_MODE=warm
+    lazy+warmup   INIT_MODE=lazy, and a {"warmup": true} event before the
+                  first request
+
+Columns are the median (p50) and p95 over --runs of: init (prediction.INIT_SEC),
+first and second request latency, and the wall time of the whole process
+(interpreter start to exit).
+
+Usage:
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 20 --latency-ms 10 --json
+"""
+# Only what the child process needs is imported here. Anything else would
+# already be loaded when the child imports prediction.py (e.g. http.server
+# pulls in http.client, which boto3 uses), and hide part of its init
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# name -> (INIT_MODE, send a warmup event first)
+SCENARIOS = {
+    "eager": ("eager", False),
+    "lazy": ("lazy", False),
+    "warm": ("warm", False),
+    "lazy+warmup": ("lazy", True),
+}
+
+
+def make_dynamodb_handler(latency_sec: float):
+    """Request handler of a minimal DynamoDB endpoint (Query, UpdateItem)"""
+    from http.server import BaseHTTPRequestHandler
+    from bench import ACTIVITIES
+
+    class DynamoDBHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            operation = self.headers.get("X-Amz-Target", "").split(".")[-1]
+            if operation == "Query":
+                items = [
+                    {"activity": {"S": act}, "cnt": {"N": str(i + 1)}}
+                    for i, act in enumerate(ACTIVITIES)
+                ]
+                res = {"Items": items, "Count": len(items),
+                       "ScannedCount": len(items)}
+            else:
+                res = dict()
+            time.sleep(latency_sec)
+            data = json.dumps(res).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-amz-json-1.0")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    return DynamoDBHandler
+
+
+def run_child(warmup: bool):
+    """Import prediction and serve two requests; print the timings as JSON"""
+    sys.path.insert(0, os.path.join(ROOT_DIR, "lambda"))
+    start = time.perf_counter()
+    import prediction
+    import_sec = time.perf_counter() - start
+
+    if warmup:
+        prediction.handler({"warmup": True}, None)
+    latencies = []
+    for _ in range(2):
+        start = time.perf_counter()
+        res = prediction.handler({"gender": "male"}, None)
+        latencies.append(time.perf_counter() - start)
+        if not res.get("recommended_activity"):
+            raise RuntimeError(f"No recommendation: {res}")
+    print(json.dumps({
+        "init_sec": prediction.INIT_SEC,
+        "import_sec": import_sec,
+        "first_request_sec": latencies[0],
+        "second_request_sec": latencies[1],
+    }))
+
+
+def run_scenario(name: str, runs: int, endpoint: str) -> List[Dict[str, float]]:
+    """Start runs fresh processes of scenario name"""
+    import subprocess
+    init_mode, warmup = SCENARIOS[name]
+    env = dict(
+        os.environ,
+        INIT_MODE=init_mode,
+        AWS_ENDPOINT_URL_DYNAMODB=endpoint,
+        AWS_ACCESS_KEY_ID="bench",
+        AWS_SECRET_ACCESS_KEY="bench",
+        METRICS_FORMAT="",
+        REQUEST_LOG_PATH="",
+    )
+    cmd = [sys.executable, os.path.abspath(__file__), "--child"]
+    if warmup:
+        cmd.append("--warmup")
+
+    results = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        proc = subprocess.run(
+            cmd, env=env, stdout=subprocess.PIPE, universal_newlines=True)
+        process_sec = time.perf_counter() - start
+        if proc.returncode:
+            raise RuntimeError(f"Run of {name} failed")
+        result = json.loads(proc.stdout.splitlines()[-1])
+        result["process_sec"] = process_sec
+        results.append(result)
+    return results
+
+
+def summarize(name: str, results: List[Dict[str, float]]) -> Dict[str, float]:
+    """p50/p95 (ms) of every timing of results"""
+    from bench import percentile
+    summary = {"scenario": name, "runs": len(results)}
+    for key in ("init_sec", "first_request_sec", "second_request_sec",
+                "process_sec"):
+        values = [r[key] for r in results]
+        name_ms = key.replace("_sec", "")
+        summary[f"{name_ms}_p50_ms"] = round(percentile(values, 50) * 1000, 2)
+        summary[f"{name_ms}_p95_ms"] = round(percentile(values, 95) * 1000, 2)
+    return summary
+
+
+def print_table(summaries: List[dict]):
+    columns = ("init", "first_request", "second_request", "process")
+    header = f"{'scenario':<12} {'n':>4}" + "".join(
+        f" {c + ' p50/p95 ms':>28}" for c in columns)
+    print(header)
+    print("-" * len(header))
+    for s in summaries:
+        print(f"{s['scenario']:<12} {s['runs']:>4}" + "".join(
+            f" {s[c + '_p50_ms']:>18.1f} /{s[c + '_p95_ms']:>8.1f}"
+            for c in columns))
+
+
+def main():
+    # Checked before argparse is imported, see the imports
+    if "--child" in sys.argv:
+        run_child("--warmup" in sys.argv)
+        return
+
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=tuple(SCENARIOS) + ("all",),
+                        default="all")
+    parser.add_argument("--runs", type=int, default=10,
+                        help="fresh processes per scenario")
+    parser.add_argument("--latency-ms", type=float, default=0.0,
+                        help="latency of every local DynamoDB call")
+    parser.add_argument("--json", action="store_true",
+                        help="print the results as JSON lines")
+    args = parser.parse_args()
+
+    import threading
+    from http.server import ThreadingHTTPServer
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), make_dynamodb_handler(args.latency_ms / 1000))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+
+    names = tuple(SCENARIOS) if args.scenario == "all" else (args.scenario,)
+    summaries = []
+    try:
+        for name in names:
+            summaries.append(summarize(name, run_scenario(name, args.runs, endpoint)))
+    finally:
+        server.shutdown()
+
+    if args.json:
+        for summary in summaries:
+            print(json.dumps(summary))
+    else:
+        print_table(summaries)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Process-wide registry of boto3 clients
+
+Clients are created once per (service, region) with a tuned botocore
+Config and shared by every caller and thread (boto3 clients are thread
+safe), so the endpoint/credential resolution and the HTTP connection pool
+are paid for once per process. Every client is wrapped in an
+InstrumentedClient, which times each API call in the aws_call_seconds
+histogram (see metrics.py).
+
+boto3 is imported when the first client is created, so a process pays for
+the import only once it needs a client. LazyClient defers even that to the
+first API call.
+
+The same module is shipped in frontend/, backend/ and lambda/ (each
+directory is built as its own Docker image). Keep the copies identical
+(checked by make check_shared).
+"""
+import os
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from metrics import counter, timer
+
+MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))
+CONNECT_TIMEOUT_SEC = float(os.getenv("AWS_CONNECT_TIMEOUT_SEC", "5"))
+READ_TIMEOUT_SEC = float(os.getenv("AWS_READ_TIMEOUT_SEC", "60"))
+MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "3"))
+
+# botocore.config.Config arguments of every client
+CLIENT_CONFIG = dict(
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    connect_timeout=CONNECT_TIMEOUT_SEC,
+    read_timeout=READ_TIMEOUT_SEC,
+    tcp_keepalive=True,
+    retries={
+        "max_attempts": MAX_ATTEMPTS,
+        "mode": "standard",
+    },
+)
+
+
+class InstrumentedClient(object):
+    """Proxy of a client that times every method call
+
+    Calls are observed in aws_call_seconds{service, operation} and failed
+    ones counted in aws_call_errors_total{service, operation}. Everything
+    else (exceptions, meta, ...) is the wrapped client's.
+    """
+
+    def __init__(self, client: Any, service_name: str):
+        self._client = client
+        self._service_name = service_name
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._client, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with timer("aws_call_seconds", service=self._service_name, operation=name):
+                try:
+                    return attr(*args, **kwargs)
+                except Exception:
+                    counter("aws_call_errors_total",
+                            service=self._service_name, operation=name).inc()
+                    raise
+
+        # Later lookups find the wrapper without going through __getattr__
+        self.__dict__[name] = call
+        return call
+
+
+# (service name, region) -> client
+_clients: Dict[Tuple[str, Optional[str]], Any] = dict()
+_lock = threading.Lock()
+
+
+def get_client(service_name: str, region_name: Optional[str] = None) -> Any:
+    """Get the shared client of service_name in region_name
+
+    Args:
+        service_name (str): e.g. "dynamodb"
+        region_name (Optional[str]): e.g. "us-east-1"
+
+    Returns:
+        Any: boto3 client
+    """
+    key = (service_name, region_name)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+                from botocore.config import Config
+                client = InstrumentedClient(boto3.client(
+                    service_name,
+                    region_name=region_name,
+                    config=Config(**CLIENT_CONFIG),
+                ), service_name)
+                _clients[key] = client
+    return client
+
+
+class LazyClient(object):
+    """Client of (service_name, region_name) looked up in the registry on use
+
+    Nothing is created (or imported) until the first method call, and a
+    client registered later with set_client is picked up.
+    """
+
+    def __init__(self, service_name: str, region_name: Optional[str] = None):
+        self._service_name = service_name
+        self._region_name = region_name
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(get_client(self._service_name, self._region_name), name)
+
+
+def set_client(service_name: str, client: Any, region_name: Optional[str] = None):
+    """Register client for (service_name, region_name), e.g. a local fake
+
+    The client is instrumented like the ones of get_client.
+
+    Args:
+        service_name (str): [description]
+        client (Any): [description]
+        region_name (Optional[str]): [description]
+    """
+    with _lock:
+        _clients[(service_name, region_name)] = InstrumentedClient(
+            client, service_name)
+
+
+def clear_clients():
+    """Forget all clients"""
+    with _lock:
+        _clients.clear()
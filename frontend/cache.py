@@ -0,0 +1,74 @@
+"""Per-process caches for the Streamlit frontend
+
+Streamlit re-executes main.py on every interaction, so anything that has to
+outlive a rerun lives in an imported module like this one.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+# Max number of jobs kept in JOB_CACHE
+JOB_CACHE_SIZE = int(os.getenv("JOB_CACHE_SIZE", "1024"))
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache with an optional per-entry time to live
+
+    Entries stored with ttl=None never expire; they are only evicted when
+    the cache is full (least recently used first).
+    """
+
+    def __init__(self, maxsize: int):
+        """A new TTLCache
+
+        Args:
+            maxsize (int): max number of entries
+        """
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value of key, or default if missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Store value under key
+
+        Args:
+            key (Hashable): [description]
+            value (Any): [description]
+            ttl (Optional[float]): seconds until the entry expires. None
+                keeps it until it is evicted
+        """
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """Remove key and return its value"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+
+# jobId -> AppJobs item, shared by all sessions of this process
+JOB_CACHE = TTLCache(JOB_CACHE_SIZE)
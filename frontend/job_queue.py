@@ -0,0 +1,180 @@
+"""Queue of new-job events between the frontend and the backend
+
+The frontend publishes {"jobId": ..., "requestedTs": ...} right after it
+writes a new job to AppJobs, and the backend receives the event and claims
+the job, instead of polling the jobToDo index.
+
+JOB_QUEUE selects the implementation:
+    ""       no queue (the backend polls AppJobs)
+    "sqs"    SQSJobQueue on JOB_QUEUE_URL
+    "local"  LocalJobQueue, spooled in JOB_QUEUE_DIR (in memory if unset)
+
+The same module is shipped in frontend/ and backend/ (each directory is
+built as its own Docker image). Keep the copies identical
+(checked by make check_shared).
+"""
+import json
+import logging
+import math
+import os
+import queue
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, List, Optional, Tuple
+
+from aws_clients import get_client
+
+logger = logging.getLogger(__name__)
+
+JOB_QUEUE = os.getenv("JOB_QUEUE", "").lower()
+JOB_QUEUE_URL = os.getenv("JOB_QUEUE_URL", "")
+JOB_QUEUE_DIR = os.getenv("JOB_QUEUE_DIR", "")
+JOB_QUEUE_REGION = os.getenv("JOB_QUEUE_REGION", "us-east-1")
+
+# Sleep between two scans of a LocalJobQueue spool directory
+LOCAL_SCAN_SEC = 0.05
+
+
+class JobQueue(ABC):
+    """Interface of a new-job event queue (at-least-once delivery)"""
+
+    @abstractmethod
+    def publish(self, event: dict):
+        """Send one event"""
+
+    @abstractmethod
+    def receive(self, max_events: int, wait_sec: float) -> List[Tuple[dict, Any]]:
+        """Wait up to wait_sec for events
+
+        Returns:
+            List[Tuple[dict, Any]]: (event, receipt) pairs. An event that is
+                not acked is delivered again later
+        """
+
+    @abstractmethod
+    def ack(self, receipt: Any):
+        """Delete a received event"""
+
+
+class SQSJobQueue(JobQueue):
+    """JobQueue on an SQS queue, received with long polling"""
+
+    def __init__(self, queue_url: str, sqs_client: Optional[Any] = None):
+        self.queue_url = queue_url
+        self.sqs_client = sqs_client or get_client("sqs", JOB_QUEUE_REGION)
+
+    def publish(self, event: dict):
+        self.sqs_client.send_message(
+            QueueUrl=self.queue_url,
+            MessageBody=json.dumps(event),
+        )
+
+    def receive(self, max_events: int, wait_sec: float) -> List[Tuple[dict, Any]]:
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max(1, min(max_events, 10)),
+            # Rounded up: a wait below 1 s would be a short poll
+            WaitTimeSeconds=max(0, min(math.ceil(wait_sec), 20)),
+        )
+        events = []
+        for message in response.get("Messages", []):
+            try:
+                event = json.loads(message["Body"])
+            except ValueError:
+                logger.error(f"Drop malformed job event: {message['Body']}")
+                self.ack(message["ReceiptHandle"])
+                continue
+            events.append((event, message["ReceiptHandle"]))
+        return events
+
+    def ack(self, receipt: Any):
+        self.sqs_client.delete_message(
+            QueueUrl=self.queue_url,
+            ReceiptHandle=receipt,
+        )
+
+
+class LocalJobQueue(JobQueue):
+    """Local stand-in for SQS, for development and tests
+
+    With a spool directory, each event is a JSON file that a receiver claims
+    by renaming it, so several processes on one host can share the queue.
+    Without one, events live in an in-process queue.Queue. Unacked events
+    of a spool directory are not redelivered.
+    """
+
+    def __init__(self, spool_dir: Optional[str] = None):
+        self.spool_dir = spool_dir
+        self._queue = queue.Queue()
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+
+    def publish(self, event: dict):
+        if not self.spool_dir:
+            self._queue.put(event)
+            return
+        name = f"{time.time():.6f}-{uuid.uuid4().hex}"
+        tmp_path = os.path.join(self.spool_dir, name + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(event, f)
+        os.rename(tmp_path, os.path.join(self.spool_dir, name + ".json"))
+
+    def receive(self, max_events: int, wait_sec: float) -> List[Tuple[dict, Any]]:
+        if not self.spool_dir:
+            events = []
+            try:
+                events.append((self._queue.get(timeout=wait_sec), None))
+                while len(events) < max_events:
+                    events.append((self._queue.get_nowait(), None))
+            except queue.Empty:
+                pass
+            return events
+
+        deadline = time.monotonic() + wait_sec
+        while True:
+            events = []
+            names = sorted(
+                n for n in os.listdir(self.spool_dir) if n.endswith(".json"))
+            for name in names:
+                path = os.path.join(self.spool_dir, name)
+                claimed_path = path + ".claimed"
+                try:
+                    os.rename(path, claimed_path)
+                except OSError:
+                    # Claimed by another receiver
+                    continue
+                with open(claimed_path) as f:
+                    events.append((json.load(f), claimed_path))
+                if len(events) >= max_events:
+                    break
+            if events or time.monotonic() >= deadline:
+                return events
+            time.sleep(LOCAL_SCAN_SEC)
+
+    def ack(self, receipt: Any):
+        if receipt:
+            os.remove(receipt)
+
+
+_job_queue = None
+
+
+def get_job_queue() -> Optional[JobQueue]:
+    """Get the process-wide JobQueue configured by JOB_QUEUE
+
+    Returns:
+        Optional[JobQueue]: None if no queue is configured
+    """
+    global _job_queue
+    if _job_queue is None:
+        if JOB_QUEUE == "sqs":
+            if JOB_QUEUE_URL:
+                _job_queue = SQSJobQueue(JOB_QUEUE_URL)
+            else:
+                logger.error("JOB_QUEUE=sqs but JOB_QUEUE_URL is not set")
+        elif JOB_QUEUE == "local":
+            _job_queue = LocalJobQueue(JOB_QUEUE_DIR or None)
+        elif JOB_QUEUE:
+            logger.error(f"Unknown JOB_QUEUE {JOB_QUEUE}")
+    return _job_queue
@@ -0,0 +1,156 @@
+"""Lambda invocation with a deadline, hedged requests and jittered retries
+
+invoke_lambda runs the synchronous boto3 invoke on a thread pool and waits
+for at most deadline_sec, so the caller's latency is bounded no matter how
+slow Lambda is. Failed attempts are retried after a jittered exponential
+backoff, and an idempotent request that has not answered after hedge_sec is
+duplicated (the first answer wins).
+
+Every call is timed in lambda_invoke_seconds{function} and counted in
+lambda_invoke_total{function,outcome}, outcome being "ok" or "failed".
+
+The same module is shipped in frontend/ and backend/ (each directory is
+built as its own Docker image). Keep the copies identical
+(checked by make check_shared).
+"""
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Optional
+
+from metrics import counter, timer
+
+logger = logging.getLogger(__name__)
+
+LAMBDA_DEADLINE_SEC = float(os.getenv("LAMBDA_DEADLINE_SEC", "5"))
+LAMBDA_HEDGE_SEC = float(os.getenv("LAMBDA_HEDGE_SEC", "1"))
+LAMBDA_MAX_ATTEMPTS = int(os.getenv("LAMBDA_MAX_ATTEMPTS", "3"))
+LAMBDA_BACKOFF_BASE_SEC = float(os.getenv("LAMBDA_BACKOFF_BASE_SEC", "0.1"))
+LAMBDA_INVOKE_CONCURRENCY = int(os.getenv("LAMBDA_INVOKE_CONCURRENCY", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=LAMBDA_INVOKE_CONCURRENCY)
+
+
+def _invoke_once(
+    lambda_client: Any,
+    function_name: str,
+    qualifier: str,
+    payload: str,
+) -> dict:
+    """Invoke the function once and parse its response
+
+    Raises:
+        RuntimeError: if the function itself fails
+    """
+    response = lambda_client.invoke(
+        FunctionName=function_name,
+        Payload=payload,
+        Qualifier=qualifier,
+    )
+    if response.get("FunctionError"):
+        raise RuntimeError(
+            f"{function_name} failed: {response['Payload'].read()!r}")
+    return json.loads(response['Payload'].read())
+
+
+def invoke_lambda(
+    lambda_client: Any,
+    function_name: str,
+    qualifier: str,
+    payload: dict,
+    idempotent: bool = True,
+    deadline_sec: float = LAMBDA_DEADLINE_SEC,
+    hedge_sec: float = LAMBDA_HEDGE_SEC,
+    max_attempts: int = LAMBDA_MAX_ATTEMPTS,
+) -> Optional[dict]:
+    """Invoke a Lambda function and wait for at most deadline_sec
+
+    Args:
+        lambda_client (Any): Lambda client
+        function_name (str): [description]
+        qualifier (str): [description]
+        payload (dict): event sent to the function
+        idempotent (bool): whether the request may run more than once. Only
+            idempotent requests are hedged
+        deadline_sec (float): max time to wait for an answer
+        hedge_sec (float): start a duplicate request if an idempotent one has
+            not answered after this long
+        max_attempts (int): max number of requests, hedges included
+
+    Returns:
+        Optional[dict]: response payload. None if every attempt fails or the
+            deadline is missed. Requests still running after the deadline
+            finish in the background and their result is dropped
+    """
+    with timer("lambda_invoke_seconds", function=function_name):
+        result = _invoke_with_deadline(
+            lambda_client, function_name, qualifier, json.dumps(payload),
+            idempotent, deadline_sec, hedge_sec, max_attempts)
+    counter("lambda_invoke_total", function=function_name,
+            outcome="failed" if result is None else "ok").inc()
+    return result
+
+
+def _invoke_with_deadline(
+    lambda_client: Any,
+    function_name: str,
+    qualifier: str,
+    payload: str,
+    idempotent: bool,
+    deadline_sec: float,
+    hedge_sec: float,
+    max_attempts: int,
+) -> Optional[dict]:
+    """invoke_lambda with the payload already serialized"""
+    start = time.monotonic()
+    deadline = start + deadline_sec
+    pending = set()
+    attempts = 0
+    next_attempt_at = start
+
+    while True:
+        now = time.monotonic()
+        if now >= deadline:
+            break
+
+        # Start an attempt: the first one, a retry after a failure, or a hedge
+        if attempts < max_attempts and now >= next_attempt_at:
+            attempts += 1
+            pending.add(_executor.submit(
+                _invoke_once, lambda_client, function_name, qualifier, payload))
+            next_attempt_at = now + hedge_sec if idempotent else deadline
+
+        if not pending and attempts >= max_attempts:
+            break
+
+        if attempts < max_attempts:
+            timeout = min(deadline, next_attempt_at) - now
+        else:
+            timeout = deadline - now
+        if not pending:
+            # Waiting for the backoff of the next retry to pass
+            time.sleep(max(timeout, 0))
+            continue
+        done, pending = wait(
+            pending, timeout=max(timeout, 0), return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                return future.result()
+            except Exception as e:
+                logger.warning(
+                    f"Attempt to invoke {function_name} failed. "
+                    f"Exception message: {e}"
+                )
+                backoff = random.uniform(
+                    0, LAMBDA_BACKOFF_BASE_SEC * 2 ** (attempts - 1))
+                next_attempt_at = min(
+                    next_attempt_at, time.monotonic() + backoff)
+
+    logger.error(
+        f"No answer from {function_name} after {attempts} attempts in "
+        f"{time.monotonic() - start:.2f} seconds"
+    )
+    return None
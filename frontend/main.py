@@ -4,15 +4,25 @@ import uuid
 import time
 import datetime
 import base64
-import boto3
-import json
 from typing import Tuple, Any, Optional
 
 import pandas as pd
-import numpy as np
 import streamlit as st
+try:
+    from streamlit_autorefresh import st_autorefresh
+except ImportError:
+    # Optional: without it, the job page has a "Refresh" button instead
+    st_autorefresh = None
 
 import SessionState
+from aws_clients import get_client
+from cache import JOB_CACHE
+from job_queue import get_job_queue
+from lambda_invoker import invoke_lambda
+from metrics import maybe_flush as maybe_flush_metrics, timer
+from request_log import log_request
+from sampler import ActivitySampler
+from scaler import get_scaling_controller
 
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
@@ -25,6 +35,13 @@ LAMBDA_REGION = os.getenv("LAMBDA_REGION", "us-east-1")
 
 REGION = 'us-east-1'
 TABLE_NAME = "AppJobs"
+# Lifetime of the presigned S3 URLs handed out for job results
+PRESIGNED_URL_EXPIRES_SEC = int(os.getenv("PRESIGNED_URL_EXPIRES_SEC", "3600"))
+# How long an unfinished job status is served from JOB_CACHE. Finished jobs
+# are immutable and cached until evicted. A running job may suggest a longer
+# time with pollAfterSec, up to JOB_STATUS_MAX_TTL_SEC
+JOB_STATUS_TTL_SEC = float(os.getenv("JOB_STATUS_TTL_SEC", "5"))
+JOB_STATUS_MAX_TTL_SEC = float(os.getenv("JOB_STATUS_MAX_TTL_SEC", "60"))
 INDEX_NAME = "jobToDo-requestedTs-index"
 
 
@@ -54,6 +71,44 @@ def get_table_download_link(df):
     return href
 
 
+def get_s3_download_link(
+    bucket: str,
+    key: str,
+    s3_client: Any,
+    expires_sec: int = PRESIGNED_URL_EXPIRES_SEC,
+) -> Optional[str]:
+    """Generates a link to download an S3 object through a presigned URL
+
+    The browser downloads the object straight from S3, so the file never
+    passes through the frontend.
+
+    Args:
+        bucket (str): [description]
+        key (str): [description]
+        s3_client (Any): [description]
+        expires_sec (int): lifetime of the URL
+
+    Returns:
+        Optional[str]: href string. None if the URL cannot be generated
+    """
+    filename = key.rsplit("/", 1)[-1]
+    try:
+        url = s3_client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": bucket,
+                "Key": key,
+                "ResponseContentDisposition": f'attachment; filename="{filename}"',
+            },
+            ExpiresIn=expires_sec,
+        )
+    except Exception as e:
+        logger.error(
+            f"Failed to generate presigned URL. Bucket = {bucket}. Key = {key}. Exception message: {e}")
+        return None
+    return f'<a href="{url}">Download {filename}</a>'
+
+
 def recommend_activity(gender: str, past_act: str, activity_db: dict) -> Tuple[list, str]:
     """Recommend activity based on gender and past_act
 
@@ -74,65 +129,115 @@ def recommend_activity(gender: str, past_act: str, activity_db: dict) -> Tuple[l
                 activity_db[gender][past_act] = 1
             else:
                 activity_db[gender][past_act] += 1
-            logger.info(activity_db)
+            logger.debug("activity_db = %s", activity_db)
 
-    # Get possible activities and total count
-    act_list = []
-    prob_list = []
+    # Get possible activities and their count
+    act_cnt = dict()
     for gender_tmp, act_cnt_map in activity_db.items():
         if gender == gender_tmp or gender not in all_gen:
             for act, cnt in act_cnt_map.items():
-                act_list.append(act)
-                prob_list.append(cnt)
-    total_cnt = sum(prob_list)
-    prob_list = [float(v) / total_cnt for v in prob_list]
+                act_cnt[act] = act_cnt.get(act, 0) + cnt
+    sampler = ActivitySampler(act_cnt)
 
-    logger.info(f"act_list = {act_list}, prob_list = {prob_list}")
+    logger.debug("act_cnt = %s", act_cnt)
 
     # Select a activity
-    rng = np.random.default_rng()
-    act = rng.choice(act_list, size=1, replace=False, p=prob_list)[0]
-    return act_list, act
+    with timer("sample_seconds"):
+        activity = sampler.draw()
+    return sampler.activities, activity
+
+
+def generate_plan(
+    gender: str,
+    tstart: datetime.date,
+    tend: datetime.date,
+    activity_db: dict,
+) -> pd.DataFrame:
+    """Generate daily activity plan for [tstart, tend) from activity_db
+
+    All activities are drawn from one ActivitySampler call and the date
+    column is built with pd.date_range, so the cost does not grow with a
+    per-day loop.
+
+    Args:
+        gender (str): [description]
+        tstart (datetime.date): first day of the plan
+        tend (datetime.date): day after the last day of the plan
+        activity_db (dict): Activity DB
+
+    Returns:
+        pd.DataFrame: columns "date" and "activity"
+    """
+    num_days = max((tend - tstart).days, 0)
+    gender = gender.lower()
+
+    act_cnt = dict()
+    for gender_tmp, act_cnt_map in activity_db.items():
+        if gender == gender_tmp or gender not in activity_db:
+            for act, cnt in act_cnt_map.items():
+                act_cnt[act] = act_cnt.get(act, 0) + cnt
+
+    with timer("sample_seconds"):
+        activities = ActivitySampler(act_cnt).draw(num_days)
+    with timer("dataframe_build_seconds", stage="plan"):
+        return pd.DataFrame({
+            "date": pd.date_range(tstart, periods=num_days, freq="D"),
+            "activity": activities,
+        })
 
 
 def recommend_activity_lambda(
     gender: str,
     past_act: str,
     lambda_client: Any,
-) -> Tuple[list, str]:
+) -> Tuple[list, str, bool]:
     """Get activity recommendation by invoking Lambda function
 
+    Falls back to the local recommend_activity(INIT_ACTIVITY_DB) model if
+    Lambda does not answer within LAMBDA_DEADLINE_SEC (see lambda_invoker).
+
     Args:
         gender (str): [description]
         past_act (str): [description]
         lambda_client (Any): Lambda client
 
     Returns:
-        Tuple[list, str]: [description]
+        list: all possible activities
+        str: recommended activity
+        bool: whether it comes from the local fallback model, i.e. past_act
+            may not have been counted by Lambda
     """
-    payload = json.dumps(
+    start = time.perf_counter()
+    res = invoke_lambda(
+        lambda_client,
+        LAMBDA_FUNCTION_NAME,
+        LAMBDA_QUALIFIER,
         {
             "gender": gender,
             "past_act": past_act,
-        }
+        },
+        idempotent=not past_act,
     )
-    # Invoke Lambda fucntion (no re-try for now)
-    try:
-        response = lambda_client.invoke(
-            FunctionName=LAMBDA_FUNCTION_NAME,
-            Payload=payload,
-            Qualifier=LAMBDA_QUALIFIER
-        )
-
-        res = json.loads(response['Payload'].read())
-    except Exception as e:
-        logger.error(
-            f"Cannot invoke Lambda function: {LAMBDA_FUNCTION_NAME}. Return no recommendation."
-            f"Error message: {e}"
+    cache_info = (res or {}).get("metadata", {}).get("cache", {})
+    fallback = not res or not res.get("recommended_activity")
+    log_request(
+        "frontend",
+        "recommend",
+        time.perf_counter() - start,
+        gender=gender,
+        past_act=past_act,
+        cache={g: info.get("status") for g, info in cache_info.items()},
+        fallback=fallback,
+    )
+    if fallback:
+        logger.warning(
+            f"No recommendation from Lambda function: {LAMBDA_FUNCTION_NAME}. "
+            "Use local model instead."
         )
-        return [], ""
+        act_list, rec_act = recommend_activity(gender, "", INIT_ACTIVITY_DB)
+        return act_list, rec_act, True
 
-    return res.get("activity_list", []), res.get("recommended_activity", "")
+    return res.get("activity_list", []), res.get("recommended_activity", ""), False
 
 
 def activity_now(session_state):
@@ -149,18 +254,38 @@ def activity_now(session_state):
     # act_list, rec_act = recommend_activity(
     #    gender, past_activity, session_state.act_db)
 
-    # Invoke Lambda recommend_activity
-    act_list, rec_act = recommend_activity_lambda(
-        gender,
-        past_activity,
-        session_state.lambda_client,
-    )
-    if not rec_act:
+    refresh = st.button("Recommend another activity")
+
+    # Invoke Lambda recommend_activity only when the inputs change or the
+    # user asks for another recommendation; plain reruns reuse the last one
+    inputs = (gender, past_activity)
+    rec = session_state.recommendation
+    if rec is None or rec["inputs"] != inputs or refresh:
+        # Report each (gender, past_activity) once per session so reruns do
+        # not inflate the activity count
+        past_act = past_activity
+        if inputs in session_state.reported_past_acts:
+            past_act = ""
+        act_list, rec_act, fallback = recommend_activity_lambda(
+            gender,
+            past_act,
+            session_state.lambda_client,
+        )
+        if rec_act:
+            # Only Lambda counts past_act; retry it after a fallback answer
+            if past_act and not fallback:
+                session_state.reported_past_acts.add(inputs)
+            rec = {"inputs": inputs, "act_list": act_list, "rec_act": rec_act}
+            session_state.recommendation = rec
+        else:
+            rec = None
+
+    if rec is None:
         st.write("Something is wrong with the system. No recommendation available.")
     else:
         st.write(
-            f"Based on your input, among all possible activies {act_list}, my recommendation is... ")
-        st.markdown(f"**{rec_act}**")
+            f"Based on your input, among all possible activies {rec['act_list']}, my recommendation is... ")
+        st.markdown(f"**{rec['rec_act']}**")
 
 
 def submit_request(requestID: str, gender: str, tstart: datetime.date, tend: datetime.date, session_state):
@@ -174,60 +299,6 @@ def submit_request(requestID: str, gender: str, tstart: datetime.date, tend: dat
     }
 
 
-def is_any_running_backend_ecs_task(ecs_client) -> bool:
-    """Check if there is any ECS backend task with desiredStatus = "RUNNING"
-
-    Args:
-        ecs_client ([type]): [description]
-
-    Returns:
-        bool:
-            True: there is at least one task with desiredStatus = "RUNNING"
-            False: otherwise
-    """
-    try:
-        response = ecs_client.list_tasks(
-            cluster="ml-app-frontend",
-            family="ml_app_backend",
-            desiredStatus="RUNNING",
-        )
-    except Exception as e:
-        logger.error(
-            f"Failed to call ecs_client.list_tasks(...). Exception message: {e}")
-        return False
-    else:
-        num_tasks = len(response.get('taskArns', []))
-        logger.info(
-            f"There are {num_tasks} ml_app_backend tasks with desiredStatus = 'RUNNING'")
-        return num_tasks > 0
-
-
-def run_backend_ecs_tasks(ecs_client):
-    """Run backend ECS tasks
-
-    Args:
-        ecs_client ([type]): [description]
-    """
-    try:
-        logger.info("Run ml_app_backend:1 task")
-        _ = ecs_client.run_task(
-            cluster="arn:aws:ecs:us-east-1:381982364978:cluster/ml-app-frontend",
-            count=1,
-            launchType="FARGATE",
-            taskDefinition="ml_app_backend:1",
-            networkConfiguration={
-                "awsvpcConfiguration": {
-                    'subnets': ["subnet-c66e8999"],
-                    'securityGroups': ["sg-09af5a1923947eac8"],
-                    'assignPublicIp': 'ENABLED'
-                }
-            }
-        )
-    except Exception as e:
-        logger.error(
-            f"Failed to run ml_app_backend:1 task. Exception message: {e}")
-
-
 def submit_request_dynamodb(
     requestID: str,
     gender: str,
@@ -236,6 +307,7 @@ def submit_request_dynamodb(
     dynamodb_client: Any,
 ) -> bool:
     submission_time = time.time()
+    requested_ts = str(submission_time)
     logger.info(f"Submite requestID: {requestID} at {submission_time}")
     try:
         response = dynamodb_client.put_item(
@@ -245,7 +317,7 @@ def submit_request_dynamodb(
                     "S": requestID,
                 },
                 "requestedTs": {
-                    "N": str(time.time()),
+                    "N": requested_ts,
                 },
                 "jobToDo": {
                     "S": 'Y',
@@ -280,6 +352,27 @@ def submit_request_dynamodb(
             logger.error(
                 f"Put new item get non-200 return code. full respose = {response}")
             return False
+    log_request(
+        "frontend",
+        "job",
+        time.time() - submission_time,
+        ts=submission_time,
+        gender=gender,
+        tstart=tstart.strftime("%Y-%m-%d"),
+        tend=tend.strftime("%Y-%m-%d"),
+    )
+
+    # Wake up a backend right away. If this fails, the job still waits in the
+    # jobToDo index for a polling backend
+    job_queue = get_job_queue()
+    if job_queue is not None:
+        try:
+            job_queue.publish({"jobId": requestID, "requestedTs": requested_ts})
+        except Exception as e:
+            logger.error(
+                f"Fail to publish new job event. jobId = {requestID}. "
+                f"Exception message: {e}"
+            )
     return True
 
 
@@ -307,8 +400,10 @@ def plan_daily_activity(session_state):
             #submit_request(req_id, gender, tstart, tend, session_state)
             ok = submit_request_dynamodb(req_id, gender, tstart,
                                          tend, session_state.dynamodb_client)
-            if ok and not is_any_running_backend_ecs_task(session_state.ecs_client):
-                run_backend_ecs_tasks(session_state.ecs_client)
+            if ok:
+                # At least one task for the new job, even if the index does
+                # not show it yet
+                get_scaling_controller().reconcile(min_tasks=1)
 
 
 def get_activity(req_id: str, gender: str, tstart: datetime.date, tend: datetime.date, session_state) -> pd.DataFrame:
@@ -323,19 +418,7 @@ def get_activity(req_id: str, gender: str, tstart: datetime.date, tend: datetime
     Returns:
         pd.DataFrame: [description]
     """
-    data = {
-        "date": [],
-        "activity": [],
-    }
-    day = tstart
-    while day < tend:
-        _, rec_act = recommend_activity(gender, "", session_state.act_db)
-        data["date"].append(day)
-        data["activity"].append(rec_act)
-        day += datetime.timedelta(days=1)
-
-    df = pd.DataFrame(data)
-    return df
+    return generate_plan(gender, tstart, tend, session_state.act_db)
 
 
 def download_job(jobId: str, dynamodb_client: Any) -> Optional[dict]:
@@ -378,6 +461,65 @@ def download_job(jobId: str, dynamodb_client: Any) -> Optional[dict]:
             return response.get("Items")[0]
 
 
+def download_job_cached(jobId: str, dynamodb_client: Any) -> Optional[dict]:
+    """Download job from DynamoDB through the per-process JOB_CACHE
+
+    Jobs with status 'Done' are kept until evicted; other statuses expire
+    after the pollAfterSec suggested by the backend (see get_poll_after_sec).
+    Errors and unknown jobIds are not cached.
+
+    Args:
+        jobId (str): [description]
+        dynamodb_client (Any): [description]
+
+    Returns:
+        Optional[dict]: see download_job
+    """
+    item = JOB_CACHE.get(jobId)
+    if item is not None:
+        logger.debug(f"Job cache hit: jobId = {jobId}")
+        return item
+
+    item = download_job(jobId, dynamodb_client)
+    if item:
+        done = item.get('jobStatus', {}).get('S') in ('Done', 'Failed')
+        JOB_CACHE.set(jobId, item, ttl=None if done else get_poll_after_sec(item))
+    return item
+
+
+def get_poll_after_sec(item: dict) -> float:
+    """How long to wait before checking the status of an unfinished job again
+
+    Args:
+        item (dict): job
+
+    Returns:
+        float: pollAfterSec of the job within [JOB_STATUS_TTL_SEC,
+            JOB_STATUS_MAX_TTL_SEC], or JOB_STATUS_TTL_SEC if it has none
+    """
+    poll_after_sec = float(item.get('pollAfterSec', {}).get('N', 0))
+    return min(max(poll_after_sec, JOB_STATUS_TTL_SEC), JOB_STATUS_MAX_TTL_SEC)
+
+
+def show_job_progress(item: dict):
+    """Show the progress bar of a running job
+
+    Args:
+        item (dict): job
+    """
+    days_total = int(item.get('daysTotal', {}).get('N', 0))
+    if not days_total:
+        return
+    days_done = min(int(item.get('daysDone', {}).get('N', 0)), days_total)
+    st.progress(days_done / days_total)
+    message = f"{days_done} of {days_total} days planned"
+    days_per_sec = float(item.get('daysPerSec', {}).get('N', 0))
+    if days_per_sec > 0:
+        eta_sec = float(item.get('etaSec', {}).get('N', 0))
+        message += f" ({days_per_sec:.1f} days/s, about {eta_sec:.0f} seconds left)"
+    st.write(message)
+
+
 def download_daily_activity(session_state):
     st.subheader("Download daily activity")
 
@@ -402,37 +544,13 @@ def download_daily_activity(session_state):
             st.write(f"{req_id} is not ready yet. Please try again latter.")
 
 
-def download_csv_from_s3(bucket: str, key: str, s3_client: Any) -> Optional[pd.DataFrame]:
-    """Download CSV from s3
-
-    Args:
-        key (str): [description]
-        s3_client (Any): [description]
-
-    Returns:
-        pd.DataFrame: [description]
-    """
-    try:
-        response = s3_client.get_object(
-            Bucket=bucket,
-            Key=key
-        )
-        df = pd.read_csv(response["Body"])
-    except Exception as e:
-        logger.error(
-            f"Failed to download S3 file as pd.Dataframe. Bucket = {bucket}. Key = {key}. Exception message: {e}")
-        return None
-    else:
-        return df
-
-
 def download_daily_activity_dynamodb(session_state):
     st.subheader("Download daily activity")
 
     req_id = st.text_input("Request ID")
 
     if req_id:
-        item = download_job(req_id, session_state.dynamodb_client)
+        item = download_job_cached(req_id, session_state.dynamodb_client)
 
         if item is None:
             st.write(
@@ -447,20 +565,40 @@ def download_daily_activity_dynamodb(session_state):
             jobStatus = item.get('jobStatus', {}).get('S', 'UNKNOWN')
             st.write(
                 f"The current job status is: '{jobStatus}' ")
+            if jobStatus == 'Failed':
+                st.write(
+                    "The job cannot be run: "
+                    f"{item.get('jobError', {}).get('S', 'unknown error')}")
+            elif jobStatus != 'Done':
+                show_job_progress(item)
+                # Rerun when the cached status expires, so the page polls at
+                # the pace suggested by the backend. The browser triggers the
+                # rerun, so the script never blocks waiting for it
+                poll_after_sec = get_poll_after_sec(item)
+                if st_autorefresh is not None and st.checkbox(
+                        "Refresh automatically", value=True):
+                    st_autorefresh(
+                        interval=int(poll_after_sec * 1000), key="job_refresh")
+                    st.write(f"Next update in {poll_after_sec:.0f} seconds")
+                else:
+                    # A click reruns the script
+                    st.button("Refresh")
             if jobStatus == 'Done':
                 bucket = item.get('outData', {}).get(
                     'M', {}).get("Bucket", {}).get('S', "")
                 key = item.get('outData', {}).get(
                     'M', {}).get("Key", {}).get('S', "")
+                fmt = item.get('outData', {}).get(
+                    'M', {}).get("Format", {}).get('S', "csv")
                 if bucket and key:
-                    df = download_csv_from_s3(
+                    href = get_s3_download_link(
                         bucket, key, session_state.s3_client)
-                    if isinstance(df, pd.DataFrame):
-                        st.markdown(get_table_download_link(
-                            df), unsafe_allow_html=True)
+                    if href:
+                        st.write(f"The result is ready ({fmt}).")
+                        st.markdown(href, unsafe_allow_html=True)
                     else:
                         st.write(
-                            "Failed to download file. Please inform the maintainer"
+                            "Failed to create download link. Please inform the maintainer"
                             f"bucket={bucket}. key={key}"
                         )
                 else:
@@ -490,6 +628,9 @@ def main(session_state):
     else:
         st.write("Not Implemented")
 
+    # Every interaction reruns the script in this process
+    maybe_flush_metrics()
+
 
 if __name__ == "__main__":
     if password == PASSWORD:
@@ -497,13 +638,13 @@ if __name__ == "__main__":
         session_state = SessionState.get(
             act_db=INIT_ACTIVITY_DB,
             requests=dict(),
+            recommendation=None,
+            reported_past_acts=set(),
         )
-        session_state.lambda_client = boto3.client(
-            'lambda', region_name=LAMBDA_REGION)
-        session_state.dynamodb_client = boto3.client(
-            'dynamodb', region_name=REGION)
-        session_state.s3_client = boto3.client('s3', region_name=REGION)
-        session_state.ecs_client = boto3.client('ecs', region_name=REGION)
+        # Clients are created once per process and shared by all sessions
+        session_state.lambda_client = get_client('lambda', LAMBDA_REGION)
+        session_state.dynamodb_client = get_client('dynamodb', REGION)
+        session_state.s3_client = get_client('s3', REGION)
 
         main(session_state)
     else:
@@ -0,0 +1,259 @@
+"""Lightweight in-process metrics: counters, histograms and timers
+
+    with timer("sample_seconds"):
+        acts = sampler.draw(count)
+    counter("act_cnt_cache_total", status="hit").inc()
+
+Metrics are always collected (a dict lookup and a lock per update) and
+written out by flush() in the format selected by METRICS_FORMAT:
+    ""            not written
+    "prometheus"  Prometheus text exposition format, written to
+                  METRICS_PATH ("-" for stdout), e.g. for the node_exporter
+                  textfile collector. Values are cumulative
+    "emf"         CloudWatch Embedded Metric Format, one JSON line per label
+                  set on stdout. Values are reset after every flush
+
+maybe_flush() flushes at most every METRICS_FLUSH_SEC, and flush() runs at
+exit.
+
+The same module is shipped in frontend/, backend/ and lambda/ (each
+directory is built as its own Docker image). Keep the copies identical
+(checked by make check_shared).
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "").lower()
+METRICS_PATH = os.getenv("METRICS_PATH", "-")
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "ml_app")
+METRICS_FLUSH_SEC = float(os.getenv("METRICS_FLUSH_SEC", "60"))
+
+# Upper bounds (seconds) of the histogram buckets
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Counter(object):
+    """Monotonic count"""
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1.0):
+        with self._lock:
+            self.value += value
+
+    def reset(self):
+        with self._lock:
+            self.value = 0.0
+
+
+class Histogram(object):
+    """Distribution of observed values over fixed buckets"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # counts[i]: observations in (buckets[i - 1], buckets[i]]; the last
+        # one counts observations above buckets[-1]
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.sum = 0.0
+            self.count = 0
+
+
+# (name, labels) -> metric
+_counters: Dict[Tuple[str, Labels], Counter] = dict()
+_histograms: Dict[Tuple[str, Labels], Histogram] = dict()
+_registry_lock = threading.Lock()
+_last_flush_ts = time.monotonic()
+
+
+def _key(name: str, labels: dict) -> Tuple[str, Labels]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def counter(name: str, **labels) -> Counter:
+    """Get (or create) the counter name{labels}"""
+    key = _key(name, labels)
+    metric = _counters.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = _counters.setdefault(key, Counter())
+    return metric
+
+
+def histogram(name: str, **labels) -> Histogram:
+    """Get (or create) the histogram name{labels}"""
+    key = _key(name, labels)
+    metric = _histograms.get(key)
+    if metric is None:
+        with _registry_lock:
+            metric = _histograms.setdefault(key, Histogram())
+    return metric
+
+
+@contextmanager
+def timer(name: str, **labels) -> Iterator[None]:
+    """Observe the duration of the with-block in histogram name{labels}
+
+    The duration is observed whether or not the block raises.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram(name, **labels).observe(time.perf_counter() - start)
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    with _registry_lock:
+        counters = sorted(_counters.items())
+        histograms = sorted(_histograms.items())
+
+    typed = set()
+    for (name, labels), metric in counters:
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {metric.value:g}")
+
+    for (name, labels), metric in histograms:
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        with metric._lock:
+            counts, total, count = list(metric.counts), metric.sum, metric.count
+        cumulative = 0
+        for bound, n in zip(metric.buckets, counts):
+            cumulative += n
+            le = _format_labels(labels, f'le="{bound:g}"')
+            lines.append(f"{name}_bucket{le} {cumulative}")
+        le = _format_labels(labels, 'le="+Inf"')
+        lines.append(f"{name}_bucket{le} {count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total:g}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def render_emf(reset: bool = True) -> List[dict]:
+    """Metrics observed since the last reset, as CloudWatch EMF documents
+
+    One document per label set. A histogram is sent as Values/Counts with
+    the upper bound of each non-empty bucket as its value.
+
+    Args:
+        reset (bool): reset the metrics once rendered
+
+    Returns:
+        List[dict]: EMF documents
+    """
+    docs: Dict[Labels, dict] = dict()
+    timestamp = int(time.time() * 1000)
+
+    def doc_of(labels: Labels) -> dict:
+        if labels not in docs:
+            docs[labels] = dict(labels, _aws={
+                "Timestamp": timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": METRICS_NAMESPACE,
+                    "Dimensions": [[k for k, _ in labels]],
+                    "Metrics": [],
+                }],
+            })
+        return docs[labels]
+
+    with _registry_lock:
+        counters = list(_counters.items())
+        histograms = list(_histograms.items())
+
+    for (name, labels), metric in counters:
+        if not metric.value:
+            continue
+        doc = doc_of(labels)
+        doc[name] = metric.value
+        doc["_aws"]["CloudWatchMetrics"][0]["Metrics"].append(
+            {"Name": name, "Unit": "Count"})
+        if reset:
+            metric.reset()
+
+    for (name, labels), metric in histograms:
+        with metric._lock:
+            counts = list(metric.counts)
+        if not any(counts):
+            continue
+        bounds = list(metric.buckets) + [metric.buckets[-1] * 2]
+        doc = doc_of(labels)
+        doc[name] = {
+            "Values": [b for b, n in zip(bounds, counts) if n],
+            "Counts": [n for n in counts if n],
+        }
+        doc["_aws"]["CloudWatchMetrics"][0]["Metrics"].append(
+            {"Name": name, "Unit": "Seconds"})
+        if reset:
+            metric.reset()
+    return list(docs.values())
+
+
+def flush():
+    """Write the metrics in METRICS_FORMAT (no-op if it is not set)"""
+    global _last_flush_ts
+    _last_flush_ts = time.monotonic()
+    try:
+        if METRICS_FORMAT == "emf":
+            for doc in render_emf():
+                sys.stdout.write(json.dumps(doc, separators=(",", ":")) + "\n")
+            sys.stdout.flush()
+        elif METRICS_FORMAT == "prometheus":
+            text = render_prometheus()
+            if METRICS_PATH == "-":
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            else:
+                # Atomic replace, so a scraper never reads a partial file
+                tmp_path = METRICS_PATH + ".tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(text)
+                os.replace(tmp_path, METRICS_PATH)
+    except Exception as e:
+        sys.stderr.write(f"Failed to flush metrics. Exception message: {e}\n")
+
+
+def maybe_flush():
+    """flush() if the last one is older than METRICS_FLUSH_SEC"""
+    if METRICS_FORMAT and time.monotonic() - _last_flush_ts >= METRICS_FLUSH_SEC:
+        flush()
+
+
+atexit.register(flush)
@@ -0,0 +1,79 @@
+"""Optional line-delimited log of the requests served by this process
+
+Set REQUEST_LOG_PATH to append one compact JSON record per request, e.g.
+
+    {"ts":1608910278.12,"source":"lambda","kind":"recommend","gender":"male",
+     "past_act":"","latency_ms":1.8,"cache":{"male":"hit"}}
+
+"-" writes the records to stdout instead (CloudWatch Logs on Lambda). The
+log can be replayed with benchmarks/replay.py.
+
+The same module is shipped in frontend/ and lambda/ (each directory is
+built as its own Docker image). Keep the copies identical
+(checked by make check_shared).
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+REQUEST_LOG_PATH = os.getenv("REQUEST_LOG_PATH", "")
+
+_lock = threading.Lock()
+_file = None
+
+
+def is_enabled() -> bool:
+    """Whether requests are logged"""
+    return bool(REQUEST_LOG_PATH)
+
+
+def _get_file():
+    """Open REQUEST_LOG_PATH once (line buffered). Hold _lock"""
+    global _file
+    if _file is None:
+        if REQUEST_LOG_PATH == "-":
+            _file = sys.stdout
+        else:
+            _file = open(REQUEST_LOG_PATH, "a", buffering=1)
+    return _file
+
+
+def log_request(
+    source: str,
+    kind: str,
+    latency_sec: float,
+    ts: Optional[float] = None,
+    **fields,
+):
+    """Append one request record to REQUEST_LOG_PATH (no-op if unset)
+
+    Args:
+        source (str): service that served the request, e.g. "lambda"
+        kind (str): "recommend" or "job"
+        latency_sec (float): time to serve the request
+        ts (Optional[float]): when the request arrived. Default: now minus
+            latency_sec
+        **fields: request attributes (gender, past_act, ...). None values
+            are left out
+    """
+    if not REQUEST_LOG_PATH:
+        return
+    record = {
+        "ts": round(ts if ts is not None else time.time() - latency_sec, 3),
+        "source": source,
+        "kind": kind,
+    }
+    record.update((k, v) for k, v in fields.items() if v is not None)
+    record["latency_ms"] = round(latency_sec * 1000, 3)
+    line = json.dumps(record, separators=(",", ":"), default=str)
+    try:
+        with _lock:
+            _get_file().write(line + "\n")
+    except Exception as e:
+        logger.error(f"Failed to log request. Exception message: {e}")
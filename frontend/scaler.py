@@ -0,0 +1,356 @@
+"""Scaling controller for the backend tasks
+
+ScalingController reads the number of pending jobs and the age of the oldest
+one from the jobToDo index of AppJobs, computes how many backend tasks are
+needed and starts (or stops) tasks through a TaskRunner. Pending jobs are
+new jobs plus running jobs that nobody works on anymore (their worker died),
+which a backend task resumes:
+
+    EcsTaskRunner    ml_app_backend tasks on ECS Fargate
+    LocalTaskRunner  local simulation; tasks are optionally backed by a
+                     subprocess (e.g. "python backend/main.py")
+
+The controller is reconciled by the frontend after every job submission,
+and can also run on its own with `python scaler.py`.
+"""
+import logging
+import math
+import os
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+from aws_clients import get_client
+
+logger = logging.getLogger(__name__)
+
+REGION = 'us-east-1'
+TABLE_NAME = "AppJobs"
+INDEX_NAME = "jobToDo-requestedTs-index"
+NEW_JOB_STR = "Y"
+RUNNING_JOB_STR = "R"
+
+# "ecs" or "local"
+SCALER_RUNNER = os.getenv("SCALER_RUNNER", "ecs").lower()
+# Command of a LocalTaskRunner task. Empty: tasks are only simulated
+SCALER_LOCAL_COMMAND = os.getenv("SCALER_LOCAL_COMMAND", "")
+BACKEND_MIN_TASKS = int(os.getenv("BACKEND_MIN_TASKS", "0"))
+BACKEND_MAX_TASKS = int(os.getenv("BACKEND_MAX_TASKS", "10"))
+# Jobs one backend task processes at a time (its NUM_WORKERS)
+JOBS_PER_TASK = int(os.getenv("JOBS_PER_TASK", "4"))
+# Add a task when the oldest pending job has waited longer than this
+TARGET_WAIT_SEC = float(os.getenv("TARGET_WAIT_SEC", "60"))
+# Min time between two scaling actions of one controller
+SCALE_COOLDOWN_SEC = float(os.getenv("SCALE_COOLDOWN_SEC", "30"))
+# Stop tasks above the desired count. Off by default: idle backends exit by
+# themselves after MAX_IDLE_SEC, while a stopped task drops its running jobs
+SCALE_IN = os.getenv("SCALE_IN", "0") == "1"
+SCALER_INTERVAL_SEC = float(os.getenv("SCALER_INTERVAL_SEC", "15"))
+
+ECS_CLUSTER = os.getenv(
+    "ECS_CLUSTER", "arn:aws:ecs:us-east-1:381982364978:cluster/ml-app-frontend")
+ECS_TASK_FAMILY = os.getenv("ECS_TASK_FAMILY", "ml_app_backend")
+ECS_TASK_DEFINITION = os.getenv("ECS_TASK_DEFINITION", "ml_app_backend:1")
+ECS_NETWORK_CONFIGURATION = {
+    "awsvpcConfiguration": {
+        'subnets': ["subnet-c66e8999"],
+        'securityGroups': ["sg-09af5a1923947eac8"],
+        'assignPublicIp': 'ENABLED'
+    }
+}
+
+
+class TaskRunner(ABC):
+    """Interface of what runs backend tasks"""
+
+    @abstractmethod
+    def list_tasks(self) -> List[str]:
+        """Ids of the tasks that are running or starting"""
+
+    @abstractmethod
+    def start_tasks(self, count: int) -> List[str]:
+        """Start count tasks and return their ids"""
+
+    @abstractmethod
+    def stop_tasks(self, task_ids: List[str]):
+        """Stop the given tasks"""
+
+
+class EcsTaskRunner(TaskRunner):
+    """Backend tasks on ECS Fargate"""
+
+    def __init__(self, ecs_client: Any):
+        self.ecs_client = ecs_client
+
+    def list_tasks(self) -> List[str]:
+        task_ids = []
+        kwargs = {}
+        while True:
+            response = self.ecs_client.list_tasks(
+                cluster=ECS_CLUSTER,
+                family=ECS_TASK_FAMILY,
+                desiredStatus="RUNNING",
+                **kwargs,
+            )
+            task_ids += response.get('taskArns', [])
+            if not response.get("nextToken"):
+                return task_ids
+            kwargs = {"nextToken": response["nextToken"]}
+
+    def start_tasks(self, count: int) -> List[str]:
+        task_ids = []
+        # run_task starts at most 10 tasks per call
+        while count > 0:
+            n = min(count, 10)
+            response = self.ecs_client.run_task(
+                cluster=ECS_CLUSTER,
+                count=n,
+                launchType="FARGATE",
+                taskDefinition=ECS_TASK_DEFINITION,
+                networkConfiguration=ECS_NETWORK_CONFIGURATION,
+            )
+            for failure in response.get("failures", []):
+                logger.error(f"Failed to run {ECS_TASK_DEFINITION} task: {failure}")
+            task_ids += [t["taskArn"] for t in response.get("tasks", [])]
+            count -= n
+        return task_ids
+
+    def stop_tasks(self, task_ids: List[str]):
+        for task_id in task_ids:
+            self.ecs_client.stop_task(
+                cluster=ECS_CLUSTER,
+                task=task_id,
+                reason="Scaled in by ScalingController",
+            )
+
+
+class LocalTaskRunner(TaskRunner):
+    """Local simulation of backend tasks
+
+    With a command, every task is a subprocess running it and is alive until
+    the process exits. Without one, tasks are only recorded, so the
+    controller can be exercised without running anything.
+    """
+
+    def __init__(self, command: Optional[List[str]] = None):
+        self.command = command
+        self._tasks: Dict[str, Optional[subprocess.Popen]] = dict()
+
+    def list_tasks(self) -> List[str]:
+        return [
+            task_id for task_id, proc in self._tasks.items()
+            if proc is None or proc.poll() is None
+        ]
+
+    def start_tasks(self, count: int) -> List[str]:
+        task_ids = []
+        for _ in range(count):
+            task_id = f"local-{uuid.uuid4().hex[:8]}"
+            self._tasks[task_id] = (
+                subprocess.Popen(self.command) if self.command else None)
+            task_ids.append(task_id)
+        return task_ids
+
+    def stop_tasks(self, task_ids: List[str]):
+        for task_id in task_ids:
+            proc = self._tasks.pop(task_id, None)
+            if proc is not None:
+                proc.terminate()
+
+
+class ScalingController(object):
+    """Keep the number of backend tasks in line with the pending jobs"""
+
+    def __init__(
+        self,
+        dynamodb_client: Any,
+        runner: TaskRunner,
+        min_tasks: int = BACKEND_MIN_TASKS,
+        max_tasks: int = BACKEND_MAX_TASKS,
+        jobs_per_task: int = JOBS_PER_TASK,
+        target_wait_sec: float = TARGET_WAIT_SEC,
+        cooldown_sec: float = SCALE_COOLDOWN_SEC,
+        scale_in: bool = SCALE_IN,
+    ):
+        """A new ScalingController
+
+        Args:
+            dynamodb_client (Any): [description]
+            runner (TaskRunner): [description]
+            min_tasks (int): [description]
+            max_tasks (int): [description]
+            jobs_per_task (int): jobs one task processes at a time
+            target_wait_sec (float): add a task when the oldest pending job
+                has waited longer than this
+            cooldown_sec (float): min time between two scaling actions
+            scale_in (bool): whether to stop tasks above the desired count
+        """
+        self.dynamodb_client = dynamodb_client
+        self.runner = runner
+        self.min_tasks = min_tasks
+        self.max_tasks = max_tasks
+        self.jobs_per_task = max(jobs_per_task, 1)
+        self.target_wait_sec = target_wait_sec
+        self.cooldown_sec = cooldown_sec
+        self.scale_in = scale_in
+        self._last_action_ts = float("-inf")
+        self._lock = threading.Lock()
+
+    def pending_jobs(self) -> int:
+        """Number of new jobs in the jobToDo index"""
+        depth = 0
+        kwargs = {}
+        while True:
+            response = self.dynamodb_client.query(
+                TableName=TABLE_NAME,
+                IndexName=INDEX_NAME,
+                KeyConditionExpression='jobToDo = :x',
+                ExpressionAttributeValues={':x': {'S': NEW_JOB_STR}},
+                Select="COUNT",
+                **kwargs,
+            )
+            depth += response.get("Count", 0)
+            if "LastEvaluatedKey" not in response:
+                return depth
+            kwargs = {"ExclusiveStartKey": response["LastEvaluatedKey"]}
+
+    def stalled_jobs(self) -> int:
+        """Number of running jobs that no worker holds a live lease of
+
+        Neither one of its chunks nor the job itself (see backend/main.py)
+        is leased, e.g. because its worker died, so it waits for a backend
+        task to resume it.
+        """
+        now = time.time()
+        stalled = 0
+        kwargs = {}
+        while True:
+            response = self.dynamodb_client.query(
+                TableName=TABLE_NAME,
+                IndexName=INDEX_NAME,
+                KeyConditionExpression='jobToDo = :x',
+                ExpressionAttributeValues={':x': {'S': RUNNING_JOB_STR}},
+                ProjectionExpression="chunkLeases, leaseExpiresTs",
+                **kwargs,
+            )
+            for item in response.get("Items", []):
+                leases = [
+                    lease.get("M", {}).get("leaseExpiresTs", {}).get("N", 0)
+                    for lease in item.get("chunkLeases", {}).get("M", {}).values()
+                ]
+                leases.append(item.get("leaseExpiresTs", {}).get("N", 0))
+                if all(float(ts) < now for ts in leases):
+                    stalled += 1
+            if "LastEvaluatedKey" not in response:
+                return stalled
+            kwargs = {"ExclusiveStartKey": response["LastEvaluatedKey"]}
+
+    def oldest_job_age(self) -> float:
+        """Seconds the oldest job of the jobToDo index has waited (0 if none)"""
+        response = self.dynamodb_client.query(
+            TableName=TABLE_NAME,
+            IndexName=INDEX_NAME,
+            KeyConditionExpression='jobToDo = :x',
+            ExpressionAttributeValues={':x': {'S': NEW_JOB_STR}},
+            ProjectionExpression="requestedTs",
+            ScanIndexForward=True,
+            Limit=1,
+        )
+        items = response.get("Items", [])
+        if not items:
+            return 0.0
+        return max(time.time() - float(items[0]["requestedTs"]["N"]), 0.0)
+
+    def desired_tasks(
+        self, depth: int, oldest_age: float, running: int, min_tasks: int = 0,
+    ) -> int:
+        """Number of tasks needed for depth pending jobs
+
+        Args:
+            depth (int): number of pending jobs
+            oldest_age (float): wait of the oldest pending job in seconds
+            running (int): number of running tasks
+            min_tasks (int): floor on top of self.min_tasks
+
+        Returns:
+            int: desired number of tasks, within [min_tasks, max_tasks]
+        """
+        desired = math.ceil(depth / self.jobs_per_task)
+        if depth and oldest_age > self.target_wait_sec:
+            # Jobs wait too long with the current tasks
+            desired = max(desired, running + 1)
+        return min(max(desired, self.min_tasks, min_tasks), self.max_tasks)
+
+    def reconcile(self, min_tasks: int = 0) -> Optional[int]:
+        """Start or stop tasks to reach the desired count
+
+        Args:
+            min_tasks (int): run at least this many tasks, on top of
+                self.min_tasks. E.g. 1 right after a job is submitted: the
+                jobToDo index is eventually consistent, so the new job may
+                not be counted yet
+
+        Returns:
+            Optional[int]: desired number of tasks. None if the controller is
+                cooling down or the state cannot be read
+        """
+        with self._lock:
+            if time.monotonic() - self._last_action_ts < self.cooldown_sec:
+                return None
+            try:
+                depth = self.pending_jobs() + self.stalled_jobs()
+                oldest_age = self.oldest_job_age()
+                task_ids = self.runner.list_tasks()
+            except Exception as e:
+                logger.error(f"Cannot read backend state. Exception message: {e}")
+                return None
+
+            running = len(task_ids)
+            desired = self.desired_tasks(depth, oldest_age, running, min_tasks)
+            logger.info(
+                f"{depth} pending jobs, oldest waited {oldest_age:.1f} seconds. "
+                f"{running} backend tasks, desired {desired}"
+            )
+            try:
+                if desired > running:
+                    self.runner.start_tasks(desired - running)
+                    self._last_action_ts = time.monotonic()
+                else:
+                    # Without scale-in, only stop what is above max_tasks
+                    keep = desired if self.scale_in else self.max_tasks
+                    if running > keep:
+                        self.runner.stop_tasks(task_ids[keep:])
+                        self._last_action_ts = time.monotonic()
+            except Exception as e:
+                logger.error(
+                    f"Failed to scale backend tasks from {running} to {desired}. "
+                    f"Exception message: {e}"
+                )
+            return desired
+
+
+_controller = None
+
+
+def get_scaling_controller() -> ScalingController:
+    """Get the process-wide ScalingController configured by SCALER_RUNNER"""
+    global _controller
+    if _controller is None:
+        if SCALER_RUNNER == "local":
+            runner = LocalTaskRunner(shlex.split(SCALER_LOCAL_COMMAND) or None)
+        else:
+            runner = EcsTaskRunner(get_client('ecs', REGION))
+        _controller = ScalingController(get_client('dynamodb', REGION), runner)
+    return _controller
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    controller = get_scaling_controller()
+    while True:
+        controller.reconcile()
+        time.sleep(SCALER_INTERVAL_SEC)
@@ -1,17 +1,66 @@
-from typing import Tuple, Dict
+import time
+# Start of the container init (the import of this module)
+INIT_START = time.perf_counter()
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Tuple, Dict, Iterator, Optional
+import atexit
 import logging
+import os
+import signal
+import threading
 
-import numpy as np
-import boto3
+from aws_clients import LazyClient, get_client
+from metrics import counter, histogram, timer
+from metrics import flush as flush_metrics, maybe_flush as maybe_flush_metrics
+from request_log import is_enabled as is_request_log_enabled, log_request
+
+if TYPE_CHECKING:
+    from sampler import ActivitySampler
 
 # Constants
 REGION = "us-east-1"
 TABLE_NAME = "ActivityCnt"
+# Upper bound on activities returned by one batch invocation. It keeps the
+# response well below the 6 MB Lambda payload limit.
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100000"))
+# Per-gender activity count cache kept across warm invocations
+CACHE_TTL_SEC = float(os.getenv("CACHE_TTL_SEC", "60"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "16"))
+# Write-behind buffer of ActivityCnt increments. It is flushed once it holds
+# FLUSH_MAX_PENDING (gender, activity) keys or FLUSH_INTERVAL_SEC after the
+# last flush, whichever comes first. FLUSH_MAX_PENDING = 0 writes through
+FLUSH_MAX_PENDING = int(os.getenv("FLUSH_MAX_PENDING", "25"))
+FLUSH_INTERVAL_SEC = float(os.getenv("FLUSH_INTERVAL_SEC", "5"))
+# Max number of concurrent per-gender DynamoDB queries
+QUERY_CONCURRENCY = int(os.getenv("QUERY_CONCURRENCY", "4"))
+# What the container init does before the first request:
+#   "eager"  import numpy and boto3 and create the DynamoDB client
+#   "lazy"   nothing; they are loaded by the first request that needs them
+#   "warm"   eager, plus preload the count cache and the samplers (warmup)
+INIT_MODE = os.getenv("INIT_MODE", "eager").lower()
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-client = boto3.client('dynamodb', region_name=REGION)
+client = LazyClient('dynamodb', REGION)
+
+# gender -> (fetch time, activity count), least recently used first
+_act_cnt_cache: "OrderedDict[str, Tuple[float, Dict[str, int]]]" = OrderedDict()
+_act_cnt_cache_lock = threading.Lock()
+_query_executor = ThreadPoolExecutor(max_workers=QUERY_CONCURRENCY)
+# tuple of genders -> sampler over their merged counts. An entry is dropped
+# when one of its genders is refreshed or evicted from _act_cnt_cache
+_sampler_cache: Dict[Tuple[str, ...], "ActivitySampler"] = dict()
+
+# (gender, activity) -> increment not yet written to DynamoDB
+_pending_increments: Dict[Tuple[str, str], int] = dict()
+_pending_lock = threading.Lock()
+_last_flush_ts = time.time()
+
+# Whether the next request is the first one of this container
+_cold_start = True
 
 
 INIT_ACTIVITY_DB = {
@@ -27,26 +76,66 @@ INIT_ACTIVITY_DB = {
 }
 
 
-def get_act_cnt_from_dynamodb(gender: str) -> Dict[str, int]:
-    """Get per-gender activity count from DyanmoDB
+def iter_act_cnt_pages(gender: str) -> Iterator[Dict[str, int]]:
+    """Stream per-gender activity count from DynamoDB, one query page at a time
+
+    Pages are followed through LastEvaluatedKey, and only the activity and
+    cnt attributes are read (ProjectionExpression).
 
     Args:
         gender (str): [description]
 
-    Returns:
-        Dict[str, int]: [description]
+    Yields:
+        Dict[str, int]: activity count of one page
+
+    Raises:
+        Exception: whatever client.query raises
     """
-    # Query DybamoDB
-    try:
+    kwargs = dict()
+    while True:
         response = client.query(
             TableName=TABLE_NAME,
             KeyConditionExpression='gender = :genderVal',
+            ProjectionExpression='#act, #cnt',
+            ExpressionAttributeNames={
+                '#act': 'activity',
+                '#cnt': 'cnt',
+            },
             ExpressionAttributeValues={
                 ':genderVal': {
                     'S': gender,
                 }
             },
+            **kwargs,
         )
+
+        page = dict()
+        for item in response.get('Items', []):
+            activity = item.get("activity", {}).get("S", "")
+            cnt = int(item.get("cnt", {}).get("N", '0'))
+            page[activity] = cnt
+        yield page
+
+        if "LastEvaluatedKey" not in response:
+            break
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def get_act_cnt_from_dynamodb(gender: str) -> Dict[str, int]:
+    """Get per-gender activity count from DyanmoDB
+
+    Args:
+        gender (str): [description]
+
+    Returns:
+        Dict[str, int]: [description]. Empty dict if any page fails, so a
+            truncated count is never returned
+    """
+    # Query DybamoDB and merge the pages as they arrive
+    res = dict()
+    try:
+        for page in iter_act_cnt_pages(gender):
+            res.update(page)
     except Exception as e:
         logger.error(
             f"Failed to query DynamoDB: {TABLE_NAME}. Error message: {e}. "
@@ -54,23 +143,163 @@ def get_act_cnt_from_dynamodb(gender: str) -> Dict[str, int]:
         )
         return dict()
 
-    # Create final dict
-    res = dict()
-    for item in response.get('Items', []):
-        activity = item.get("activity", {}).get("S", "")
-        cnt = int(item.get("cnt", {}).get("N", '0'))
-        res[activity] = cnt
-
-    logger.info(f"For {gender}, the activity count is: {res}")
+    logger.debug("For %s, the activity count is: %s", gender, res)
     return res
 
 
-def update_dynamodb(gender: str, activity: str):
+def get_act_cnt_cached(gender: str) -> Tuple[Dict[str, int], dict]:
+    """Get per-gender activity count, served from the in-process cache
+
+    The cache survives warm invocations. An entry is refreshed from
+    DynamoDB once it is older than CACHE_TTL_SEC, and at most CACHE_MAX_SIZE
+    genders are kept (least recently used first out). Empty results are not
+    cached, so a failed query is retried on the next request. Increments
+    still waiting in the write-behind buffer are added to a fresh copy.
+
+    Args:
+        gender (str): [description]
+
+    Returns:
+        Dict[str, int]: activity count. Do not modify it
+        dict: cache info, e.g. {"status": "hit", "age_sec": 1.5}. status is
+            "hit", "miss" (not cached) or "stale" (older than CACHE_TTL_SEC).
+            age_sec is the age of the cached entry, 0.0 on a miss
+    """
+    act_cnt, cache_info = _lookup_act_cnt_cache(gender)
+    if act_cnt is None:
+        act_cnt = _refresh_act_cnt_cache(gender)
+    return act_cnt, cache_info
+
+
+def _lookup_act_cnt_cache(gender: str) -> Tuple[Optional[Dict[str, int]], dict]:
+    """Look up the cache without querying DynamoDB
+
+    Returns:
+        Optional[Dict[str, int]]: activity count. None if it has to be
+            refreshed from DynamoDB
+        dict: cache info (see get_act_cnt_cached)
+    """
+    with _act_cnt_cache_lock:
+        entry = _act_cnt_cache.get(gender)
+        if entry is None:
+            return None, {"status": "miss", "age_sec": 0.0}
+        fetched_at, act_cnt = entry
+        age_sec = time.time() - fetched_at
+        if age_sec >= CACHE_TTL_SEC:
+            return None, {"status": "stale", "age_sec": round(age_sec, 3)}
+        _act_cnt_cache.move_to_end(gender)
+        return act_cnt, {"status": "hit", "age_sec": round(age_sec, 3)}
+
+
+def _refresh_act_cnt_cache(gender: str) -> Dict[str, int]:
+    """Query DynamoDB and store the result (plus pending increments)"""
+    now = time.time()
+    act_cnt = get_act_cnt_from_dynamodb(gender)
+    with _pending_lock:
+        for (gen, activity), cnt in _pending_increments.items():
+            if gen == gender:
+                act_cnt[activity] = act_cnt.get(activity, 0) + cnt
+    if act_cnt:
+        with _act_cnt_cache_lock:
+            _act_cnt_cache[gender] = (now, act_cnt)
+            _act_cnt_cache.move_to_end(gender)
+            _drop_samplers(gender)
+            while len(_act_cnt_cache) > CACHE_MAX_SIZE:
+                evicted, _ = _act_cnt_cache.popitem(last=False)
+                _drop_samplers(evicted)
+    return act_cnt
+
+
+def _drop_samplers(gender: str):
+    """Drop cached samplers built from gender. Hold _act_cnt_cache_lock"""
+    for genders in [key for key in _sampler_cache if gender in key]:
+        del _sampler_cache[genders]
+
+
+def get_sampler_class() -> type:
+    """sampler.ActivitySampler. numpy is imported by the first call"""
+    from sampler import ActivitySampler
+    return ActivitySampler
+
+
+def get_sampler(
+    genders: Tuple[str, ...],
+    cache_info: Optional[dict] = None,
+) -> "ActivitySampler":
+    """Get the sampler over the merged activity count of genders
+
+    The sampler is built once per count snapshot and kept until one of the
+    genders is refreshed, so consecutive requests reuse its tree.
+    Genders that are not cached are queried concurrently, so the latency
+    does not grow with the number of genders.
+
+    Args:
+        genders (Tuple[str, ...]): [description]
+        cache_info (Optional[dict]): if given, filled with the per-gender
+            cache info returned by get_act_cnt_cached
+
+    Returns:
+        ActivitySampler: [description]
+    """
+    if cache_info is None:
+        cache_info = dict()
+    act_cnt_maps = dict()
+    for gen in genders:
+        act_cnt_maps[gen], cache_info[gen] = _lookup_act_cnt_cache(gen)
+
+    # Fan out the DynamoDB queries of the genders that are not cached
+    to_refresh = [gen for gen in genders if act_cnt_maps[gen] is None]
+    if len(to_refresh) > 1:
+        refreshed = _query_executor.map(_refresh_act_cnt_cache, to_refresh)
+    else:
+        refreshed = map(_refresh_act_cnt_cache, to_refresh)
+    act_cnt_maps.update(zip(to_refresh, refreshed))
+
+    with _act_cnt_cache_lock:
+        sampler = _sampler_cache.get(genders)
+        if sampler is None:
+            merged = dict()
+            for act_cnt in act_cnt_maps.values():
+                for act, cnt in act_cnt.items():
+                    merged[act] = merged.get(act, 0) + cnt
+            sampler = get_sampler_class()(merged)
+            if all(gen in _act_cnt_cache for gen in genders):
+                _sampler_cache[genders] = sampler
+    return sampler
+
+
+def increment_cached_act_cnt(gender: str, activity: str, cnt: int = 1):
+    """Apply a local count increment to the cached copy (if cached)
+
+    Args:
+        gender (str): [description]
+        activity (str): [description]
+        cnt (int): increment
+    """
+    with _act_cnt_cache_lock:
+        entry = _act_cnt_cache.get(gender)
+        if entry is None:
+            return
+        fetched_at, act_cnt = entry
+        # Copy on write so callers holding the old map are not affected
+        act_cnt = dict(act_cnt)
+        act_cnt[activity] = act_cnt.get(activity, 0) + cnt
+        _act_cnt_cache[gender] = (fetched_at, act_cnt)
+        for genders, sampler in _sampler_cache.items():
+            if gender in genders:
+                sampler.update(activity, cnt)
+
+
+def update_dynamodb(gender: str, activity: str, cnt: int = 1) -> bool:
     """Update dynamoDB
 
     Args:
         gender (str): [description]
         activity (str): [description]
+        cnt (int): increment
+
+    Returns:
+        bool: whether the update is success or not
     """
     try:
         response = client.update_item(
@@ -86,65 +315,183 @@ def update_dynamodb(gender: str, activity: str):
             UpdateExpression="ADD cnt :x",
             ExpressionAttributeValues={
                 ':x': {
-                    'N': '1',
+                    'N': str(cnt),
                 },
             }
         )
-        logger.info(f"Update response: {response}")
+        logger.debug("Update response: %s", response)
     except Exception as e:
         logger.error(f"Failed to update DynamoDB. Exception message: {e}")
+        return False
+    return True
 
 
-def recommend_activity_dynamodb(gender: str, past_act: str) -> Tuple[list, str]:
-    """Recommend activity based on gender and past_act from DynamoDB
+def buffer_increment(gender: str, activity: str, cnt: int = 1):
+    """Record an ActivityCnt increment in the write-behind buffer
+
+    The increment is applied to the cached copy right away, and written to
+    DynamoDB by flush_increments once a size or time threshold is reached
+    (see maybe_flush_increments).
+
+    Args:
+        gender (str): [description]
+        activity (str): [description]
+        cnt (int): increment
+    """
+    with _pending_lock:
+        key = (gender, activity)
+        _pending_increments[key] = _pending_increments.get(key, 0) + cnt
+    increment_cached_act_cnt(gender, activity, cnt)
+    maybe_flush_increments()
+
+
+def maybe_flush_increments():
+    """Flush the buffer if it holds FLUSH_MAX_PENDING keys, or if
+    FLUSH_INTERVAL_SEC passed since the last flush
+
+    Checked by every handler call, so buffered increments are written even
+    when no new increment arrives.
+    """
+    with _pending_lock:
+        if not _pending_increments:
+            return
+        num_pending = len(_pending_increments)
+        last_flush_ts = _last_flush_ts
+    if (
+        num_pending >= FLUSH_MAX_PENDING
+        or time.time() - last_flush_ts >= FLUSH_INTERVAL_SEC
+    ):
+        flush_increments()
+
+
+def _write_increment(pending: Tuple[Tuple[str, str], int]) -> bool:
+    """Write one buffered increment and take it off the buffer
+
+    Args:
+        pending (Tuple[Tuple[str, str], int]): ((gender, activity), cnt)
+
+    Returns:
+        bool: whether the update is success or not
+    """
+    (gender, activity), cnt = pending
+    if not update_dynamodb(gender, activity, cnt):
+        return False
+    with _pending_lock:
+        left = _pending_increments.get((gender, activity), 0) - cnt
+        if left > 0:
+            _pending_increments[(gender, activity)] = left
+        else:
+            _pending_increments.pop((gender, activity), None)
+    return True
+
+
+def flush_increments() -> int:
+    """Write all buffered increments to DynamoDB, one ADD per key
+
+    The updates run concurrently on _query_executor. An increment stays in
+    the buffer until its update succeeds, so a failed update is retried by
+    the next flush.
+
+    Returns:
+        int: number of keys written
+    """
+    global _last_flush_ts
+    with _pending_lock:
+        pending = list(_pending_increments.items())
+        _last_flush_ts = time.time()
+
+    try:
+        written = list(_query_executor.map(_write_increment, pending))
+    except RuntimeError:
+        # The executor is shut down (interpreter exit): write one by one
+        written = [_write_increment(p) for p in pending]
+    num_written = sum(written)
+
+    if pending:
+        logger.info(
+            "Flushed %d of %d pending increments", num_written, len(pending))
+    return num_written
+
+
+def _flush_on_sigterm(signum, frame):
+    """Best-effort flush when the container is shut down"""
+    flush_increments()
+    flush_metrics()
+    raise SystemExit(0)
+
+
+atexit.register(flush_increments)
+try:
+    signal.signal(signal.SIGTERM, _flush_on_sigterm)
+except ValueError:
+    # Not imported from the main thread
+    pass
+
+
+def recommend_activities_dynamodb(
+    gender: str,
+    past_act: str,
+    count: int,
+    cache_info: Optional[dict] = None,
+) -> Tuple[list, list]:
+    """Recommend `count` activities based on gender and past_act from DynamoDB
+
+    All activities are drawn from the cached sampler in one call, so a whole
+    plan costs at most one DynamoDB read per gender instead of one per day.
 
     Args:
         gender (str): [description]
         past_act (str): [description]
+        count (int): number of activities to draw
+        cache_info (Optional[dict]): if given, filled with the per-gender
+            cache info returned by get_act_cnt_cached
 
     Returns:
-        str: [description]
+        list: all possible activities
+        list: recommended activities (len(list) == count)
     """
     all_gen = {'male', 'female'}
     gender = gender.lower()
 
-    # Update DynamoDB
+    # Update DynamoDB (write-behind) and the cached copy
     if gender in all_gen and past_act:
-        update_dynamodb(gender, past_act)
-
-    # Create activity_db
-    activity_db = dict()
-    if gender in all_gen:
-        activity_db[gender] = get_act_cnt_from_dynamodb(gender)
-    else:
-        for gen in all_gen:
-            activity_db[gen] = get_act_cnt_from_dynamodb(gen)
+        buffer_increment(gender, past_act)
 
-    # Get possible activities and total count
-    act_list = []
-    prob_list = []
-    for gender_tmp, act_cnt_map in activity_db.items():
-        for act, cnt in act_cnt_map.items():
-            act_list.append(act)
-            prob_list.append(cnt)
-    total_cnt = sum(prob_list)
+    # Undisclosed gender draws from the counts of all genders
+    genders = (gender,) if gender in all_gen else tuple(sorted(all_gen))
+    sampler = get_sampler(genders, cache_info)
 
     # Handle no activity case
-    if total_cnt == 0:
+    if sampler.total == 0:
         logger.warning(
             f"No activity found for gender = {gender}"
-            "Return [], ''"
+            "Return [], []"
         )
-        return [], ""
+        return [], []
 
-    prob_list = [float(v) / total_cnt for v in prob_list]
+    act_list = sampler.activities
+    logger.debug("act_list = %s, total_cnt = %s", act_list, sampler.total)
 
-    logger.info(f"act_list = {act_list}, prob_list = {prob_list}")
+    # Select activities
+    with timer("sample_seconds"):
+        acts = sampler.draw(count).tolist()
+    return act_list, acts
 
-    # Select a activity
-    rng = np.random.default_rng()
-    act = rng.choice(act_list, size=1, replace=False, p=prob_list)[0]
-    return act_list, act
+
+def recommend_activity_dynamodb(gender: str, past_act: str) -> Tuple[list, str]:
+    """Recommend activity based on gender and past_act from DynamoDB
+
+    Args:
+        gender (str): [description]
+        past_act (str): [description]
+
+    Returns:
+        str: [description]
+    """
+    act_list, acts = recommend_activities_dynamodb(gender, past_act, 1)
+    if not acts:
+        return [], ""
+    return act_list, acts[0]
 
 
 def recommend_activity(gender: str, past_act: str, activity_db: dict) -> Tuple[list, str]:
@@ -167,32 +514,163 @@ def recommend_activity(gender: str, past_act: str, activity_db: dict) -> Tuple[l
                 activity_db[gender][past_act] = 1
             else:
                 activity_db[gender][past_act] += 1
-            logger.info(activity_db)
+            logger.debug("%s", activity_db)
 
-    # Get possible activities and total count
-    act_list = []
-    prob_list = []
+    # Get possible activities and their count
+    act_cnt = dict()
     for gender_tmp, act_cnt_map in activity_db.items():
         if gender == gender_tmp or gender not in all_gen:
             for act, cnt in act_cnt_map.items():
-                act_list.append(act)
-                prob_list.append(cnt)
-    total_cnt = sum(prob_list)
-    prob_list = [float(v) / total_cnt for v in prob_list]
+                act_cnt[act] = act_cnt.get(act, 0) + cnt
+    sampler = get_sampler_class()(act_cnt)
 
-    logger.info(f"act_list = {act_list}, prob_list = {prob_list}")
+    logger.debug("act_cnt = %s", act_cnt)
 
     # Select a activity
-    rng = np.random.default_rng()
-    act = rng.choice(act_list, size=1, replace=False, p=prob_list)[0]
-    return act_list, act
+    with timer("sample_seconds"):
+        act = sampler.draw()
+    return sampler.activities, act
 
 
 def handler(event, context):
+    global _cold_start
+    cold_start, _cold_start = _cold_start, False
+    ts = time.time()
+    start = time.perf_counter()
+    if event.get("warmup"):
+        res = {"warmup": True, "metadata": {"cache": warmup()}}
+    else:
+        res = handle_event(event)
+    latency_sec = time.perf_counter() - start
+
+    if cold_start:
+        # The init duration is reported once, with the first request
+        res.setdefault("metadata", dict()).update(
+            cold_start=True, init_mode=INIT_MODE, init_sec=round(INIT_SEC, 4))
+        histogram("first_request_seconds", mode=INIT_MODE).observe(latency_sec)
+    if event.get("warmup"):
+        histogram("request_seconds", kind="warmup").observe(latency_sec)
+        maybe_flush_increments()
+        maybe_flush_metrics()
+        return res
+
+    # Batch size as validated by handle_event: None for a single or an
+    # invalid request
+    metadata = res.get("metadata", {})
+    count = metadata.get("count")
+    histogram(
+        "request_seconds", kind="batch" if "count" in metadata else "single",
+    ).observe(latency_sec)
+    cache = {
+        g: info.get("status")
+        for g, info in res.get("metadata", {}).get("cache", {}).items()
+    }
+    for status in cache.values():
+        counter("act_cnt_cache_total", status=status).inc()
+    if is_request_log_enabled():
+        log_request(
+            "lambda",
+            "recommend",
+            latency_sec,
+            ts=ts,
+            gender=event.get("gender", 'n/a'),
+            past_act=event.get("past_act", ""),
+            count=count,
+            cache=cache,
+        )
+    maybe_flush_increments()
+    maybe_flush_metrics()
+    return res
+
+
+def handle_event(event: dict) -> dict:
+    """Serve one recommendation request (see handler)
+
+    Args:
+        event (dict): {"gender": ..., "past_act": ...}, plus "count" or
+            "dates" for a batch request
+
+    Returns:
+        dict: response of handler. The metadata of a batch response holds
+            its batch size ("count"), None if the request is invalid
+    """
     gender = event.get("gender", 'n/a')
     past_act = event.get("past_act", "")
     logger.info(
-        f"Get request with gender = {gender} and past_act = {past_act}")
+        "Get request with gender = %s and past_act = %s", gender, past_act)
+
+    cache_info = dict()
+
+    # Batch mode: {"count": N} or {"dates": [...]} returns N activities
+    dates = event.get("dates")
+    count = event.get("count")
+    if dates is not None or count is not None:
+        try:
+            count = len(dates) if dates is not None else int(count)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Invalid batch request. Exception message: {e}")
+            return {"activity_list": [], "recommended_activities": [],
+                    "metadata": {"count": None}}
+        if count < 0 or count > MAX_BATCH_SIZE:
+            logger.error(
+                f"Batch size {count} is out of range [0, {MAX_BATCH_SIZE}]")
+            return {"activity_list": [], "recommended_activities": [],
+                    "metadata": {"count": None}}
+        act_list, acts = recommend_activities_dynamodb(
+            gender, past_act, count, cache_info)
+        res = {
+            "activity_list": act_list,
+            "recommended_activities": acts,
+            "metadata": {"cache": cache_info, "count": count},
+        }
+        if dates is not None:
+            res["dates"] = dates
+        return res
+
     #act_list, act = recommend_activity(gender, past_act, INIT_ACTIVITY_DB)
-    act_list, act = recommend_activity_dynamodb(gender, past_act)
-    return {"activity_list": act_list, "recommended_activity": act}
+    act_list, acts = recommend_activities_dynamodb(
+        gender, past_act, 1, cache_info)
+    act = acts[0] if acts else ""
+    return {
+        "activity_list": act_list,
+        "recommended_activity": act,
+        "metadata": {"cache": cache_info},
+    }
+
+
+def load_dependencies():
+    """Import numpy and boto3 and create the DynamoDB client"""
+    get_sampler_class()
+    get_client('dynamodb', REGION)
+
+
+def warmup() -> dict:
+    """Load everything the first request needs: numpy, boto3, the DynamoDB
+    client, the count cache of every gender and their samplers
+
+    Used at init in the "warm" INIT_MODE and for {"warmup": true} events
+    (e.g. sent on a schedule, or right after a deployment).
+
+    Returns:
+        dict: per-gender cache info (see get_act_cnt_cached)
+    """
+    load_dependencies()
+    cache_info = dict()
+    # Undisclosed gender. The genders are queried concurrently
+    all_gen = ('female', 'male')
+    get_sampler(all_gen, cache_info)
+    with _act_cnt_cache_lock:
+        cached = [gen for gen in all_gen if gen in _act_cnt_cache]
+    # A failed query is not retried here, so the init stays short
+    for gender in cached:
+        get_sampler((gender,))
+    return cache_info
+
+
+if INIT_MODE == "warm":
+    warmup()
+elif INIT_MODE != "lazy":
+    load_dependencies()
+INIT_SEC = time.perf_counter() - INIT_START
+histogram("init_seconds", mode=INIT_MODE).observe(INIT_SEC)
+logger.info("Init (%s) took %.1f ms", INIT_MODE, INIT_SEC * 1000)
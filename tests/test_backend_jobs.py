@@ -0,0 +1,198 @@
+"""Behaviour of the backend job state machine (backend/main.py)
+
+claim -> chunk leases -> resume -> completion, against the in-process
+DynamoDB/S3/Lambda fakes of benchmarks/fakes.py.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "backend"))
+
+from aws_clients import InstrumentedClient, set_client  # noqa: E402
+from fakes import FakeDynamoDB, FakeLambda, FakeS3, recommend_uniformly  # noqa: E402
+
+ACTIVITIES = ["basketball", "swimming", "hiking"]
+
+set_client("dynamodb", FakeDynamoDB(), "us-east-1")
+set_client("s3", FakeS3(), "us-east-1")
+set_client("lambda", FakeLambda(recommend_uniformly(ACTIVITIES)),
+           os.getenv("LAMBDA_REGION", "us-east-1"))
+import main  # noqa: E402
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    """Fresh fakes and small chunks: 2020-01-01..2020-12-31 is 4 chunks"""
+    ddb, s3 = FakeDynamoDB(), FakeS3()
+    monkeypatch.setattr(main, "client", InstrumentedClient(ddb, "dynamodb"))
+    monkeypatch.setattr(main, "s3_client", InstrumentedClient(s3, "s3"))
+    monkeypatch.setattr(main, "CHUNK_DAYS", 100)
+    return ddb, s3
+
+
+def submit(ddb: FakeDynamoDB, jobId: str = "job-1", tend: str = "2020-12-31") -> dict:
+    key = {"jobId": {"S": jobId}, "requestedTs": {"N": "1608910278"}}
+    ddb.put_item(TableName=main.TABLE_NAME, Item=dict(key, **{
+        "jobToDo": {"S": main.NEW_JOB_STR},
+        "jobStatus": {"S": "New"},
+        "input": {"M": {
+            "gender": {"S": "male"},
+            "tstart": {"S": "2020-01-01"},
+            "tend": {"S": tend},
+        }},
+    }))
+    return key
+
+
+def get_job(ddb: FakeDynamoDB, jobId: str = "job-1") -> dict:
+    return ddb.jobs[jobId]
+
+
+def assert_done(ddb: FakeDynamoDB, s3: FakeS3, jobId: str = "job-1"):
+    job = get_job(ddb, jobId)
+    assert job["jobStatus"]["S"] == "Done"
+    assert "jobToDo" not in job
+    assert job["daysDone"] == job["daysTotal"] == {"N": "365"}
+    key = job["outData"]["M"]["Key"]["S"]
+    assert (main.S3_BUCKET, key) in s3.objects
+    # Only the result is left; the chunk parts are deleted
+    assert [k for _, k in s3.objects] == [key]
+
+
+def test_new_job_is_claimed_once(aws):
+    ddb, _ = aws
+    key = submit(ddb)
+
+    item, ok = main.update_new_job(key)
+    assert ok
+    assert item["jobToDo"]["S"] == main.RUNNING_JOB_STR
+    assert item["workerId"]["S"] == main.WORKER_ID
+    assert main.update_new_job(key) == (key, False)
+    assert main.claim_jobs(5) == []
+
+
+def test_job_runs_to_done(aws):
+    ddb, s3 = aws
+    submit(ddb)
+
+    items = main.claim_work(1)
+    assert len(items) == 1
+    main.process_job(items[0])
+
+    assert_done(ddb, s3)
+    assert sorted(get_job(ddb)["chunksDone"]["NS"]) == ["0", "1", "2", "3"]
+    assert main.claim_work(5) == []
+
+
+def test_leased_chunk_cannot_be_claimed(aws):
+    ddb, _ = aws
+    item, _ = main.update_new_job(submit(ddb))
+
+    item, ok = main.claim_chunk(item, 0, 365)
+    assert ok
+    assert main.claim_chunk(item, 0, 365)[1] is False
+    assert main.get_claimable_chunks(item, 4) == [1, 2, 3]
+
+
+def test_expired_chunk_lease_is_resumed(aws, monkeypatch):
+    ddb, s3 = aws
+    item, _ = main.update_new_job(submit(ddb))
+    # A worker leases chunk 0 and dies: its lease has expired
+    monkeypatch.setattr(main, "LEASE_SEC", -1)
+    item, ok = main.claim_chunk(item, 0, 365)
+    assert ok
+    monkeypatch.setattr(main, "LEASE_SEC", 300)
+
+    items = main.claim_work(1)
+    assert [i["jobId"] for i in items] == [item["jobId"]]
+    main.process_job(items[0])
+
+    assert_done(ddb, s3)
+
+
+def test_chunk_is_counted_once(aws):
+    ddb, _ = aws
+    item, _ = main.update_new_job(submit(ddb))
+    item, _ = main.claim_chunk(item, 0, 365)
+
+    item, ok = main.complete_chunk(item, 0, 100, 365)
+    assert ok
+    assert main.complete_chunk(item, 0, 100, 365)[1] is False
+    assert get_job(ddb)["daysDone"] == {"N": "100"}
+
+
+def test_completion_is_retried_after_failed_assembly(aws, monkeypatch):
+    ddb, s3 = aws
+    submit(ddb)
+    assemble_parts_to_s3 = main.assemble_parts_to_s3
+    monkeypatch.setattr(main, "assemble_parts_to_s3", lambda *args: ("", {}))
+
+    main.process_job(main.claim_work(1)[0])
+    job = get_job(ddb)
+    assert job["jobToDo"]["S"] == main.RUNNING_JOB_STR
+    assert len(job["chunksDone"]["NS"]) == 4
+    # The failed worker still holds the job lease
+    assert main.claim_work(5) == []
+
+    # Once the lease expires, another worker completes the job
+    ddb.jobs["job-1"]["leaseExpiresTs"] = {"N": "0"}
+    monkeypatch.setattr(main, "assemble_parts_to_s3", assemble_parts_to_s3)
+    monkeypatch.setattr(main, "WORKER_ID", "other-worker")
+    items = main.claim_work(5)
+    assert len(items) == 1
+    main.process_job(items[0])
+
+    assert_done(ddb, s3)
+    assert get_job(ddb)["workerId"]["S"] == "other-worker"
+
+
+def test_completion_is_retried_after_worker_dies(aws):
+    ddb, s3 = aws
+    item, _ = main.update_new_job(submit(ddb))
+    # Every chunk is done, but the worker dies before assembling the result
+    for chunk, (tstart, tend) in enumerate(main.get_job_chunks(item)):
+        item, _ = main.claim_chunk(item, chunk, 365)
+        df = main.generate_plan("male", tstart, tend)
+        assert main.write_df_to_s3_as_csv(
+            df, main.get_part_key("job-1", chunk), compress=False, header=False)
+        item, _ = main.complete_chunk(item, chunk, (tend - tstart).days, 365)
+
+    items = main.claim_work(5)
+    assert len(items) == 1
+    main.process_job(items[0])
+
+    assert_done(ddb, s3)
+
+
+def test_job_lease_is_exclusive(aws, monkeypatch):
+    ddb, _ = aws
+    item, _ = main.update_new_job(submit(ddb))
+
+    item, ok = main.acquire_job_lease(item)
+    assert ok
+    # Taken again by its holder, not by another worker
+    assert main.acquire_job_lease(item)[1]
+    monkeypatch.setattr(main, "WORKER_ID", "other-worker")
+    assert main.acquire_job_lease(item)[1] is False
+
+
+@pytest.mark.parametrize("claimed", [False, True])
+def test_invalid_job_fails(aws, claimed):
+    ddb, _ = aws
+    key = submit(ddb, tend="not a date")
+    if claimed:
+        # Left running by an older worker: failed by the running-job scan
+        main.update_new_job(key)
+        assert main.find_running_jobs(5) == []
+    else:
+        main.process_job(main.claim_work(1)[0])
+
+    job = get_job(ddb)
+    assert job["jobStatus"]["S"] == "Failed"
+    assert job["jobError"]["S"]
+    assert "jobToDo" not in job
+    assert main.claim_work(5) == []
@@ -0,0 +1,47 @@
+"""Behaviour of the Lambda handler (lambda/prediction.py) on batch requests"""
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "lambda"))
+os.environ.setdefault("INIT_MODE", "lazy")
+
+from aws_clients import InstrumentedClient  # noqa: E402
+from fakes import FakeDynamoDB  # noqa: E402
+import prediction  # noqa: E402
+
+EMPTY_BATCH = {"activity_list": [], "recommended_activities": []}
+
+
+@pytest.fixture(autouse=True)
+def dynamodb(monkeypatch):
+    ddb = FakeDynamoDB({"male": {"basketball": 3, "swimming": 1}})
+    monkeypatch.setattr(prediction, "client", InstrumentedClient(ddb, "dynamodb"))
+    return ddb
+
+
+@pytest.mark.parametrize("batch", [
+    {"dates": 5},
+    {"dates": 1.5},
+    {"count": "many"},
+    {"count": [1]},
+    {"count": -1},
+    {"count": prediction.MAX_BATCH_SIZE + 1},
+])
+def test_malformed_batch_returns_empty_batch(batch):
+    res = prediction.handler(dict(gender="male", **batch), None)
+
+    assert {k: res[k] for k in EMPTY_BATCH} == EMPTY_BATCH
+    assert res["metadata"]["count"] is None
+
+
+def test_batch_reports_its_size():
+    res = prediction.handler(
+        {"gender": "male", "dates": ["2020-01-01", "2020-01-02"]}, None)
+
+    assert len(res["recommended_activities"]) == 2
+    assert res["dates"] == ["2020-01-01", "2020-01-02"]
+    assert res["metadata"]["count"] == 2
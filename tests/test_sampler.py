@@ -0,0 +1,52 @@
+"""Behaviour of ActivitySampler (sampler.py, shipped in every service)"""
+import os
+import sys
+from collections import Counter
+
+import numpy as np
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, "lambda"))
+
+from sampler import ActivitySampler  # noqa: E402
+
+DRAWS = 100000
+
+
+def frequencies(sampler: ActivitySampler) -> dict:
+    cnt = Counter(sampler.draw(DRAWS))
+    return {act: n / DRAWS for act, n in cnt.items()}
+
+
+def test_draws_are_proportional_to_counts():
+    sampler = ActivitySampler(
+        {"basketball": 3, "swimming": 1, "hiking": 0},
+        rng=np.random.default_rng(0))
+
+    freq = frequencies(sampler)
+    assert "hiking" not in freq
+    assert freq["basketball"] == pytest.approx(0.75, abs=0.01)
+
+
+def test_update_applies_to_the_next_draw():
+    sampler = ActivitySampler({"basketball": 1}, rng=np.random.default_rng(0))
+    sampler.draw(10)
+    # New activities past the initial capacity, and an existing one
+    sampler.update("swimming", 2)
+    sampler.update("hiking", 3)
+    sampler.update("basketball", 2)
+
+    assert sampler.counts() == {"basketball": 3, "swimming": 2, "hiking": 3}
+    assert sampler.total == 8
+    freq = frequencies(sampler)
+    assert freq["swimming"] == pytest.approx(0.25, abs=0.01)
+    assert freq["hiking"] == pytest.approx(0.375, abs=0.01)
+
+
+def test_draw_shapes():
+    sampler = ActivitySampler({"basketball": 1})
+    assert sampler.draw() == "basketball"
+    assert len(sampler.draw(0)) == 0
+    with pytest.raises(ValueError):
+        ActivitySampler({}).draw()